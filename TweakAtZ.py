@@ -30,6 +30,25 @@
 ##V4.9.94: Bugfix Combobox-selection; remove logger
 ##V5.0:   Bugfix for fall back after one layer and doubled G0 commands when using print speed tweak, Initial version for Cura 2.x
 ##V5.0.1: Bugfix for calling unknown property 'bedTemp' of previous settings storage and unkown variable 'speed'
+##V5.1 (development): single pass G-code tokenizer, bugfix for unknown variable 'printspeed'
+##        layers are rebuilt slice by slice with append and join
+##        layers without changes are passed through as they are (no extra empty line at the end of a layer anymore)
+##        standalone command line use on G-code files (streamed layer by layer)
+##        several TweakAtZ settings (entries) can be applied in a single pass
+##        parallel processing of large G-code on several cores (optional)
+##        layer index sidecar files for standalone use
+##        optional instrumentation (counters and timings)
+##        print moves of the print speed tweak rewritten in bulk
+##        results of execute cached by a digest of G-code and settings (memory and optionally disk)
+##        incremental execute: a run with other settings on the same G-code skips the layers in front of the tweak
+##        dispatch of lines by command word or comment tag (no more matches of commands within comments)
+##        G-code files memory-mapped for standalone use; unchanged layers are copied from the mapping undecoded
+##        batch mode for folders of G-code files (process pool, report per job)
+##        patch output (executePatch): the changes only, applied when the G-code is written
+##        enabled tweaks compiled into a plan with a precomputed ramp table
+##        schedules: any no. of breakpoints over height or layer no. (step or linear) in a single pass
+##        gzip (and zstd, if available) compressed G-code files read and written as streams
+##        generator variants of execute and processFile, which yield each layer as soon as it is done
 
 ## Uses -
 ## M220 S<factor in percent> - set speed factor override percentage
@@ -40,14 +59,222 @@
 ## M106 S<PWM> - set fan speed to target speed <S>
 ## M605/606 to save and recall material settings on the UM2
 
-from ..Script import Script
+try:
+    from ..Script import Script
+except (ImportError, SystemError, ValueError): #no PostProcessingPlugin around: TweakAtZ runs on its own (see main)
+    Script = object
 #from UM.Logger import Logger
+import bisect
+import collections
+import gzip
+import hashlib
+import json
+import mmap
+import os
 import re
+import sys
+import time
+try:
+    import zstandard #optional, for zstd compressed G-code files (see openGCode)
+except ImportError:
+    zstandard = None
+
+#precompiled patterns of the G-code tokenizer (see parseLine):
+_NUMBER = re.compile(r"-?[0-9]+\.?[0-9]*") #the minus at the beginning allows for negative values, e.g. for delta printers
+_PARAMETER = re.compile(r"([A-Z])(" + _NUMBER.pattern + ")?") #a letter and, if present, its value
+_STATE_VALUE = re.compile(r"[0-4]")
+_LAYER_VALUE = re.compile(r"[+-]?[0-9]+") #a sign alone is no layer no.
+
+class GCodeLine(object):
+    ## A G-code line parsed once into a parameter map (the command word is found by processLines).
+    #  The parameter map holds the first occurrence of each letter in front of the comment (as in getValue)
+    #  plus the values of the ";TweakAtZ-state" and ";LAYER:" comments. Values are converted on access only.
+    __slots__ = ("line", "params")
+
+    def __init__(self, line, params):
+        self.line = line
+        self.params = params
+
+    def getValue(self, key, default = None):
+        value = self.params.get(key)
+        if value: #neither missing nor without number
+            return float(value)
+        return default
+
+## Tokenizes a G-code line in a single pass (replaces repeated getValue calls on the same line)
+def parseLine(line):
+    comment = line.find(";")
+    if comment == -1:
+        code = line
+    else:
+        code = line[:comment]
+    #reversed, so the first occurrence of a letter wins
+    params = dict(reversed(_PARAMETER.findall(code)))
+    if comment != -1:
+        for key, pattern in ((";TweakAtZ-state", _STATE_VALUE), (";LAYER:", _LAYER_VALUE)):
+            position = line.find(key, comment)
+            if position != -1:
+                m = pattern.match(line, position + len(key))
+                if m:
+                    params[key] = m.group(0)
+    return GCodeLine(line, params)
+
+## Yields the lines of a layer (as active_layer.split("\n") would) in slices of roughly size characters,
+#  which bounds the memory used for line and output pieces on very large layers
+def splitLines(text, size = 65536):
+    start = 0
+    while True:
+        end = text.find("\n", start + size)
+        if end == -1:
+            yield text[start:].split("\n")
+            return
+        yield text[start:end].split("\n")
+        start = end + 1
+
+#the command word of a line for TweakProcessor.handlers (T for any tool change), behind a check of its first character
+_COMMAND_WORD = re.compile(r"[GM][0-9]+|T")
+_COMMAND_LETTERS = frozenset("GMT")
+
+## Compiles a regex which finds any of the given tokens (see TweakProcessor.getStateTokens). It's written with a leading
+#  character class of their first characters, which lets the regex engine skip over the other lines quickly.
+def compileTokens(tokens):
+    groups = collections.OrderedDict()
+    for token in sorted(tokens):
+        groups.setdefault(token[0], []).append(re.escape(token[1:]))
+    return re.compile("[%s](?:%s)" % ("".join(re.escape(first) for first in groups),
+                                      "|".join("(?<=%s)(?:%s)" % (re.escape(first), "|".join(rests))
+                                               for first, rests in groups.items())))
+
+## Returns the lines of a layer which can change the state of TweakAtZ, without splitting the whole layer
+#  (token: the regex of the processors, see getStateToken; by default the one of TweakProcessor)
+def scanLines(text, token = None):
+    return [text[start:end] for start, end in iterStateLines(text, token)]
+
+## Yields start and end (the position of its line end) of each line of a layer which can change the state of TweakAtZ
+def iterStateLines(text, token = None):
+    search = (token or _STATE_TOKEN).search
+    position = 0
+    while True:
+        m = search(text, position)
+        if m == None:
+            return
+        start = text.rfind("\n", 0, m.start()) + 1
+        end = text.find("\n", m.end())
+        if end == -1:
+            end = len(text)
+        yield start, end
+        position = end + 1
+
+#a print move as Cura writes it, which is rewritten by the print speed tweak, or else any G1 line with an F in front of
+#its comment (which might be a print move written differently); the G1 lines without F are never rewritten
+_PRINT_MOVE = re.compile(r"^(?:G1 F(" + _NUMBER.pattern + ") X(" + _NUMBER.pattern + ") Y(" + _NUMBER.pattern +
+                         ") E(" + _NUMBER.pattern + ")$|(?=[^;\n]*F)(G0?1(?![0-9]).*)$)", re.M)
+_PRINT_MOVE_FORMAT = "G1 F%d X%1.3f Y%1.3f E%1.5f"
+
+## Digest of a list of layers (the layer boundaries count as well)
+def digestLayers(data):
+    digest = hashlib.sha1()
+    for active_layer in data:
+        digest.update(b"%d\n" % len(active_layer))
+        digest.update(active_layer.encode(_ENCODING, _ERRORS))
+    return digest.hexdigest()
+
+## Cache of the results of TweakAtZ.execute, addressed by a digest of the G-code and the settings: saving the same
+#  sliced job again costs only the digest. The results are kept in memory and, with a directory, also on disk
+#  (one file per result, so they survive a restart); both are bounded in size and evict the least recently used.
+#  max_size: characters in memory, max_disk_size: bytes on disk
+class ResultCache(object):
+    extension = ".tzcache"
+
+    def __init__(self, max_size = 1 << 26, directory = None, max_disk_size = 1 << 30):
+        self.max_size = max_size
+        self.directory = directory
+        self.max_disk_size = max_disk_size
+        self.results = collections.OrderedDict() #least recently used first
+        self.size = 0
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+    ## The key of a result: the digest of the G-code (see digestLayers) and the settings
+    @staticmethod
+    def getKey(data_digest, settings):
+        digest = hashlib.sha1(json.dumps(settings, sort_keys = True, default = str).encode(_ENCODING))
+        digest.update(data_digest.encode("ascii"))
+        return digest.hexdigest()
+
+    ## Returns a copy of the cached result, or None
+    def get(self, key):
+        result = self.results.get(key)
+        if result is not None:
+            self.results.move_to_end(key)
+            self.stats["hits"] += 1
+            return list(result)
+        if self.directory is not None:
+            path = os.path.join(self.directory, key + self.extension)
+            try:
+                with open(path, "r", encoding = _ENCODING) as cache_file:
+                    result = json.load(cache_file)
+                os.utime(path) #the modification time orders the files for eviction
+            except (OSError, ValueError):
+                pass
+            else:
+                self.stats["disk_hits"] += 1
+                self.store(key, result)
+                return list(result)
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, key, data):
+        result = list(data)
+        self.store(key, result)
+        if self.directory is not None:
+            try:
+                os.makedirs(self.directory, exist_ok = True)
+                path = os.path.join(self.directory, key + self.extension)
+                with open(path + ".tmp", "w", encoding = _ENCODING) as cache_file:
+                    json.dump(result, cache_file, separators = (",", ":"))
+                if os.path.getsize(path + ".tmp") > self.max_disk_size: #would only evict all the others
+                    os.remove(path + ".tmp")
+                    return
+                os.replace(path + ".tmp", path)
+                self.evictFiles()
+            except OSError: #the disk cache is optional
+                pass
+
+    def store(self, key, result):
+        size = sum(len(active_layer) for active_layer in result)
+        if size > self.max_size:
+            return
+        if key in self.results:
+            self.size -= sum(len(active_layer) for active_layer in self.results.pop(key))
+        self.results[key] = result
+        self.size += size
+        while self.size > self.max_size:
+            self.size -= sum(len(active_layer) for active_layer in self.results.popitem(last = False)[1])
+            self.stats["evictions"] += 1
+
+    def evictFiles(self):
+        files = [entry for entry in os.scandir(self.directory) if entry.name.endswith(self.extension)]
+        files.sort(key = lambda entry: entry.stat().st_mtime_ns)
+        size = sum(entry.stat().st_size for entry in files)
+        for entry in files:
+            if size <= self.max_disk_size:
+                break
+            size -= entry.stat().st_size
+            os.remove(entry.path)
+            self.stats["evictions"] += 1
+
+    def clear(self):
+        self.results.clear()
+        self.size = 0
 
 class TweakAtZ(Script):
-    version = "5.0.1"
+    version = "5.1"
+    parallel_min_size = 1 << 22 #characters of G-code below which execute doesn't start worker processes
+    cache = ResultCache() #shared by all instances; None to turn caching off
+    incremental = True #False: execute doesn't keep the scan state of the last run (see execute)
     def __init__(self):
         super().__init__()
+        self._last_run = None #digest of the data and LayerIndex of the last run of execute
 
     def getSettingData(self):
         return {
@@ -306,14 +533,13 @@ class TweakAtZ(Script):
         if not key in line or (";" in line and line.find(key) > line.find(";") and
                                    not ";TweakAtZ" in key and not ";LAYER:" in key):
             return default
-        subPart = line[line.find(key) + len(key):] #allows for string lengths larger than 1
+        start = line.find(key) + len(key) #allows for string lengths larger than 1
         if ";TweakAtZ" in key:
-            m = re.search("^[0-4]", subPart)
+            m = _STATE_VALUE.match(line, start)
         elif ";LAYER:" in key:
-            m = re.search("^[+-]?[0-9]*", subPart)
+            m = _LAYER_VALUE.match(line, start)
         else:
-            #the minus at the beginning allows for negative values, e.g. for delta printers
-            m = re.search("^[-]?[0-9]+\.?[0-9]*", subPart)
+            m = _NUMBER.match(line, start)
         if m == None:
             return default
         try:
@@ -321,18 +547,267 @@ class TweakAtZ(Script):
         except:
             return default
 
-    def execute(self, data):
+    def getDefaultSettings(self):
+        return dict((key, setting["default"]) for key, setting in self.getSettingData()["settings"].items())
+
+    ## Creates one state machine per entry. An entry is a dictionary of settings (keys as in getSettingData, e.g.
+    #  trigger, target, behavior and the tweaks to apply), missing keys take the default value. Without entries,
+    #  the settings of this instance are used.
+    #  With instrument, the state machines count and time their work (see InstrumentedProcessor).
+    #  An entry may also be a Schedule, which gets a ScheduleProcessor.
+    def createProcessors(self, entries = None, instrument = False):
+        processor_class = InstrumentedProcessor if instrument else TweakProcessor
+        if entries is None:
+            return [processor_class(self.getSettingValueByKey, self.version)]
+        processors = []
+        for settings in self.resolveSettings(entries):
+            if isinstance(settings, Schedule): #no tweaks of its own and a target which is never reached
+                schedule_class = InstrumentedScheduleProcessor if instrument else ScheduleProcessor
+                neutral = dict(self.getDefaultSettings(), b_targetZ = float("inf"))
+                processors.append(schedule_class(neutral.__getitem__, self.version, settings))
+            else:
+                processors.append(processor_class(settings.__getitem__, self.version))
+        return processors
+
+    ## Returns the complete settings of each entry (see createProcessors), or of this instance without entries
+    def resolveSettings(self, entries = None):
+        if entries is None:
+            return [dict((key, self.getSettingValueByKey(key)) for key in self.getSettingData()["settings"])]
+        defaults = self.getDefaultSettings()
+        resolved = []
+        for entry in entries:
+            if isinstance(entry, Schedule):
+                resolved.append(entry)
+                continue
+            unknown = set(entry) - set(defaults)
+            if unknown:
+                raise ValueError("Unknown TweakAtZ setting(s): %s" % ", ".join(sorted(unknown)))
+            settings = dict(defaults)
+            settings.update(entry)
+            resolved.append(settings)
+        return resolved
+
+    ## With a list of entries (see createProcessors), all of them are applied in a single scan over data, with the
+    #  same result as that many stacked TweakAtZ instances.
+    #  workers: no. of processes to use (None: all cores); data smaller than parallel_min_size is done sequentially
+    #  instrument: True to collect counters and timings into self.report (see buildReport), "comment" to also add
+    #  a summary as comment at the end of the G-code; without it, nothing is counted at all
+    #  The results are kept in self.cache (see ResultCache), an instrumented run always processes the data.
+    #  With incremental, a sequential run keeps the scan state at each layer in front of the target (a LayerIndex
+    #  of the data); another run on the same data with other settings restores it and passes the layers in front
+    #  of the earlier of both targets through without scanning them.
+    def execute(self, data, entries = None, workers = 1, instrument = False):
+        start = time.perf_counter()
+        cache = None if instrument else self.cache
+        data_digest = digestLayers(data) if cache is not None or self.incremental else None
+        if cache is not None:
+            key = cache.getKey(data_digest, [self.version] + self.resolveSettings(entries))
+            result = cache.get(key)
+            if result is not None:
+                data[:] = result
+                return data
+        processors = self.createProcessors(entries, instrument)
+        timings = {} if instrument else None
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers > 1 and sum(len(active_layer) for active_layer in data) >= self.parallel_min_size:
+            self._last_run = None
+            data[:] = processLayersParallel(processors, data, workers, timings)
+        else:
+            index = None
+            first = 0
+            if self.incremental:
+                if self._last_run is not None and self._last_run[0] == data_digest:
+                    index = self._last_run[1]
+                    entry = index.findEntry(processors)
+                    if entry is not None: #the header is processed, the layers up to the entry are passed through
+                        header = index.entries[0][0]
+                        data[:header] = processLayers(processors, data[:header])
+                        index.restore(processors, entry)
+                        index.truncate(entry)
+                        first = entry[0]
+                    else:
+                        index = None
+                if index is None:
+                    index = LayerIndex(None)
+                self._last_run = (data_digest, index)
+            position = first
+            for active_layer in processLayers(processors, data[first:] if first else data, index, first):
+                data[position] = active_layer
+                position += 1
+        if instrument:
+            self.report = buildReport(processors, time.perf_counter() - start, timings)
+            if instrument == "comment" and data:
+                data[-1] += formatReport(self.report, self.version)
+        if cache is not None:
+            cache.put(key, data)
+        return data
+
+    ## Like execute, but leaves data as it is and returns the changes only, as a patch: a list of records
+    #  (layer index, line offset, text, removed), see TweakProcessor.patchLayer. Without the print speed tweak, the
+    #  records just insert lines, apart from the ";TweakAtZ instances" lines, which are replaced.
+    #  applyPatch or writePatched put data and patch together.
+    def executePatch(self, data, entries = None):
+        processors = self.createProcessors(entries)
+        token = getStateToken(processors)
+        patch = []
+        for index, active_layer in enumerate(data):
+            lines = None
+            records = None #the layer is unchanged as long as there are none
+            modified_layer = active_layer
+            for processor in processors:
+                if records is None:
+                    if lines is None and not processor.rewritesMoves():
+                        lines = scanLines(active_layer, token)
+                    if not processor.passLayer(lines):
+                        records = processor.patchLayer(active_layer)
+                    continue
+                if modified_layer is active_layer:
+                    modified_layer = applyRecords(active_layer, records)
+                layer = processor.processLayer(modified_layer)
+                if layer is not modified_layer: #changed by several entries: the whole layer is replaced
+                    modified_layer = layer
+                    records = [(0, modified_layer + "\n", active_layer.count("\n") + 1)]
+            if records:
+                patch.extend((index,) + record for record in records)
+        return patch
+
+    ## Generator variant of execute: yields the layers one by one as soon as they are done, e.g. for a print host to
+    #  send the first ones to the printer while the rest is still processed. layers: any iterable of layers, also a
+    #  generator (see iterFile); the first one (the header) is yielded after it has been scanned.
+    #  As the layers are never held at once, neither the result cache nor the incremental state are used.
+    def executeIter(self, layers, entries = None):
+        return processLayers(self.createProcessors(entries), layers)
+
+## The enabled tweaks of a TweakProcessor, compiled once: their keys, format templates and target values, and the
+#  lines of each step of the ramp over twLayers. The ramp is computed at once for given old values and twLayers,
+#  which normally stay the same while the tweak is executed; it's computed again if one of them changes.
+class TweakPlan(object):
+    __slots__ = ("keys", "templates", "target_values", "_ramp_key", "_ramp")
+
+    def __init__(self, TweakProp, TweakStrings, target_values):
+        self.keys = tuple(key for key in TweakProp if TweakProp[key])
+        self.templates = tuple(TweakStrings[key] for key in self.keys)
+        self.target_values = tuple(target_values[key] for key in self.keys)
+        self._ramp_key = None
+        self._ramp = None
+
+    def isOldValueUnknown(self, old):
+        return any(old[key] == -1 for key in self.keys)
+
+    ## The lines of step done_layers (0 to twLayers - 1) of the ramp from the old values to the target values
+    def getStep(self, old, twLayers, done_layers):
+        values = tuple(old[key] for key in self.keys)
+        if (values, twLayers) != self._ramp_key:
+            targets = [float(target) for target in self.target_values]
+            self._ramp = [tuple(template % float(value + (target - float(value)) / float(twLayers) * float(step + 1))
+                                for template, value, target in zip(self.templates, values, targets))
+                          for step in range(twLayers)]
+            self._ramp_key = (values, twLayers)
+        return self._ramp[done_layers]
+
+    ## The lines which set the old values again
+    def getReset(self, old):
+        return [template % float(old[key]) for key, template in zip(self.keys, self.templates)]
+
+## A schedule of values over the height or the layer no., as an entry of TweakAtZ.execute (see ScheduleProcessor).
+#  breakpoints: any no. of (position, parameter, value, interpolation), where position is the height in mm (trigger
+#  "height") or the layer no. (trigger "layer_no") and parameter one of the tweaks (see parameters). From its
+#  breakpoint on, a value holds ("step", the default) or is interpolated linearly up to the next breakpoint of the
+#  same parameter ("linear"); the last value holds to the end. The breakpoints are sorted per parameter once, so the
+#  values at a position are looked up by bisection.
+class Schedule(object):
+    parameters = ("speed", "flowrate", "flowrateOne", "flowrateTwo", "bedTemp", "extruderOne", "extruderTwo", "fanSpeed")
+    interpolations = ("step", "linear")
+
+    def __init__(self, breakpoints, trigger = "height"):
+        if trigger not in ("height", "layer_no"):
+            raise ValueError("Unknown trigger of schedule: %s" % trigger)
+        self.trigger = trigger
+        self.breakpoints = []
+        for breakpoint in breakpoints:
+            position, parameter, value = breakpoint[:3]
+            interpolation = breakpoint[3] if len(breakpoint) > 3 else "step"
+            if parameter not in self.parameters:
+                raise ValueError("Unknown parameter of schedule: %s" % parameter)
+            if interpolation not in self.interpolations:
+                raise ValueError("Unknown interpolation of schedule: %s" % interpolation)
+            self.breakpoints.append((float(position), parameter, float(value), interpolation))
+        self.breakpoints.sort(key = lambda breakpoint: breakpoint[0]) #of the same position, the last one counts
+        self.lookup = {} #per parameter: positions, values and interpolations
+        for position, parameter, value, interpolation in self.breakpoints:
+            for column, item in zip(self.lookup.setdefault(parameter, ([], [], [])), (position, value, interpolation)):
+                column.append(item)
+        self.keys = tuple(key for key in self.parameters if key in self.lookup)
+        self.first = self.breakpoints[0][0] if self.breakpoints else float("inf")
+
+    def __repr__(self): #also the settings of the schedule in the key of the result cache
+        return "Schedule(%r, %r)" % (self.breakpoints, self.trigger)
+
+    ## Returns (parameter, value) of the parameters which have a breakpoint at or in front of position
+    def getValues(self, position):
+        values = []
+        for key in self.keys:
+            positions, points, interpolations = self.lookup[key]
+            i = bisect.bisect_right(positions, position) - 1
+            if i < 0:
+                continue
+            value = points[i]
+            if interpolations[i] == "linear" and i + 1 < len(positions):
+                value += (points[i + 1] - value) * (position - positions[i]) / (positions[i + 1] - positions[i])
+            values.append((key, value))
+        return values
+
+## The state machine of TweakAtZ, carried from line to line and from layer to layer.
+#  Layers which are not changed by the tweak are only scanned for the lines which can change the state (see scanLines)
+#  and are passed through as they are; only the layers which get insertions or rewritten lines are rebuilt.
+class TweakProcessor(object):
+    #variables carried across lines and layers (see snapshot and restore)
+    carried = ("old", "twLayers", "pres_ext", "done_layers", "z", "layer", "state", "IsUM2", "oldValueUnknown",
+               "TWinstances", "targetZ")
+    #handlers of processLines, by command word or by the tag at the beginning of a comment line; the lines to run
+    #through them are found by their keys (see getStateTokens), so a new handler needs nothing but its entry here
+    handlers = {"G0": "handleMove", "G1": "handleMove", "G00": "handleMove", "G01": "handleMove",
+                "T": "handleTool",
+                "M84": "handleEnd", "M25": "handleEnd",
+                "M140": "handleBedTemp", "M190": "handleBedTemp",
+                "M104": "handleExtruderTemp", "M109": "handleExtruderTemp",
+                "M106": "handleFan", "M107": "handleFan",
+                "M221": "handleFlowrate",
+                ";Generated with Cura_SteamEngine": "handleGenerated",
+                ";FLAVOR:UltiGCode": "handleFlavor",
+                ";TweakAtZ-state": "handleState",
+                ";TweakAtZ instances:": "handleInstances",
+                ";Small layer": "handleSmallLayer",
+                ";LAYER:": "handleLayer"}
+    #the moves, which only change the state with a Z (see handleMove); the others are plain moves
+    moves = ("G0", "G1", "G00", "G01")
+    #handlers whose lines leave the G-code unchanged in front of the target (see LayerIndex)
+    clean = frozenset(moves + ("T", "M140", "M190", "M104", "M109", "M106", "M107", "M221", ";FLAVOR:UltiGCode",
+                               ";Small layer", ";LAYER:"))
+
+    #the tokenizer as the handlers call it, parseMove for the G0/G1 moves (hooks to count them, see InstrumentedProcessor)
+    parseLine = staticmethod(parseLine)
+    parseMove = staticmethod(parseLine)
+
+    def __init__(self, getSettingValueByKey, version):
+        self.version = version
+        self._dispatch = dict((key, getattr(type(self), name)) for key, name in self.handlers.items())
+        self._comment_tag = re.compile("|".join(re.escape(key) for key in self.handlers if key.startswith(";")))
+        self._state_token = compileTokens(self.getStateTokens())
+        self._unclean_token = compileTokens(self.getUncleanTokens())
         #Check which tweaks should apply
-        TweakProp = {"speed": self.getSettingValueByKey("e1_Tweak_speed"),
-             "flowrate": self.getSettingValueByKey("g1_Tweak_flowrate"),
-             "flowrateOne": self.getSettingValueByKey("g3_Tweak_flowrateOne"),
-             "flowrateTwo": self.getSettingValueByKey("g5_Tweak_flowrateTwo"),
-             "bedTemp": self.getSettingValueByKey("h1_Tweak_bedTemp"),
-             "extruderOne": self.getSettingValueByKey("i1_Tweak_extruderOne"),
-             "extruderTwo": self.getSettingValueByKey("i3_Tweak_extruderTwo"),
-             "fanSpeed": self.getSettingValueByKey("j1_Tweak_fanSpeed")}
-        TweakPrintSpeed = self.getSettingValueByKey("f1_Tweak_printspeed")
-        TweakStrings = {"speed": "M220 S%f\n",
+        self.TweakProp = {"speed": getSettingValueByKey("e1_Tweak_speed"),
+             "flowrate": getSettingValueByKey("g1_Tweak_flowrate"),
+             "flowrateOne": getSettingValueByKey("g3_Tweak_flowrateOne"),
+             "flowrateTwo": getSettingValueByKey("g5_Tweak_flowrateTwo"),
+             "bedTemp": getSettingValueByKey("h1_Tweak_bedTemp"),
+             "extruderOne": getSettingValueByKey("i1_Tweak_extruderOne"),
+             "extruderTwo": getSettingValueByKey("i3_Tweak_extruderTwo"),
+             "fanSpeed": getSettingValueByKey("j1_Tweak_fanSpeed")}
+        self.TweakPrintSpeed = getSettingValueByKey("f1_Tweak_printspeed")
+        self.printspeed = getSettingValueByKey("f2_printspeed")
+        self.TweakStrings = {"speed": "M220 S%f\n",
             "flowrate": "M221 S%f\n",
             "flowrateOne": "M221 T0 S%f\n",
             "flowrateTwo": "M221 T1 S%f\n",
@@ -340,174 +815,1110 @@ class TweakAtZ(Script):
             "extruderOne": "M104 S%f T0\n",
             "extruderTwo": "M104 S%f T1\n",
             "fanSpeed": "M106 S%d\n"}
-        target_values = {"speed": self.getSettingValueByKey("e2_speed"),
-             "flowrate": self.getSettingValueByKey("g2_flowrate"),
-             "flowrateOne": self.getSettingValueByKey("g4_flowrateOne"),
-             "flowrateTwo": self.getSettingValueByKey("g6_flowrateTwo"),
-             "bedTemp": self.getSettingValueByKey("h2_bedTemp"),
-             "extruderOne": self.getSettingValueByKey("i2_extruderOne"),
-             "extruderTwo": self.getSettingValueByKey("i4_extruderTwo"),
-             "fanSpeed": self.getSettingValueByKey("j2_fanSpeed")}
-        old = {"speed": -1, "flowrate": -1, "flowrateOne": -1, "flowrateTwo": -1, "platformTemp": -1, "extruderOne": -1,
+        self.target_values = {"speed": getSettingValueByKey("e2_speed"),
+             "flowrate": getSettingValueByKey("g2_flowrate"),
+             "flowrateOne": getSettingValueByKey("g4_flowrateOne"),
+             "flowrateTwo": getSettingValueByKey("g6_flowrateTwo"),
+             "bedTemp": getSettingValueByKey("h2_bedTemp"),
+             "extruderOne": getSettingValueByKey("i2_extruderOne"),
+             "extruderTwo": getSettingValueByKey("i4_extruderTwo"),
+             "fanSpeed": getSettingValueByKey("j2_fanSpeed")}
+        self.plan = TweakPlan(self.TweakProp, self.TweakStrings, self.target_values)
+        self.old = {"speed": -1, "flowrate": -1, "flowrateOne": -1, "flowrateTwo": -1, "platformTemp": -1, "extruderOne": -1,
             "extruderTwo": -1, "bedTemp": -1, "fanSpeed": -1, "state": -1}
-        twLayers = self.getSettingValueByKey("d_twLayers")
-        if self.getSettingValueByKey("c_behavior") == "single_layer":
-            behavior = 1
+        self.twLayers = getSettingValueByKey("d_twLayers")
+        if getSettingValueByKey("c_behavior") == "single_layer":
+            self.behavior = 1
         else:
-            behavior = 0
+            self.behavior = 0
         try:
-            twLayers = max(int(twLayers),1) #for the case someone entered something as "funny" as -1
+            self.twLayers = max(int(self.twLayers),1) #for the case someone entered something as "funny" as -1
         except:
-            twLayers = 1
-        pres_ext = 0
-        done_layers = 0
-        z = 0
-        x = None
-        y = None
-        layer = -100000 #layer no. may be negative (raft) but never that low
+            self.twLayers = 1
+        self.pres_ext = 0
+        self.done_layers = 0
+        self.z = 0
+        self.layer = -100000 #layer no. may be negative (raft) but never that low
         # state 0: deactivated, state 1: activated, state 2: active, but below z,
         # state 3: active and partially executed (multi layer), state 4: active and passed z
-        state = 1
+        self.state = 1
         # IsUM2: Used for reset of values (ok for Marlin/Sprinter),
         # has to be set to 1 for UltiGCode (work-around for missing default values)
-        IsUM2 = False
-        oldValueUnknown = False
-        TWinstances = 0
+        self.IsUM2 = False
+        self.oldValueUnknown = False
+        self.TWinstances = 0
 
-        if self.getSettingValueByKey("a_trigger") == "layer_no":
-            targetL_i = int(self.getSettingValueByKey("b_targetL"))
-            targetZ = 100000
+        if getSettingValueByKey("a_trigger") == "layer_no":
+            self.targetL_i = int(getSettingValueByKey("b_targetL"))
+            self.targetZ = 100000
         else:
-            targetL_i = -100000
-            targetZ = self.getSettingValueByKey("b_targetZ")
-        index = 0
-        for active_layer in data:
-            modified_gcode = ""
-            lines = active_layer.split("\n")
-            for line in lines:
-                if ";Generated with Cura_SteamEngine" in line:
-                    TWinstances += 1
-                    modified_gcode += ";TweakAtZ instances: %d\n" % TWinstances
-                if not ("M84" in line or "M25" in line or ("G1" in line and TweakPrintSpeed and (state==3 or state==4)) or
-                                ";TweakAtZ instances:" in line):
-                    modified_gcode += line + "\n"
-                IsUM2 = ("FLAVOR:UltiGCode" in line) or IsUM2 #Flavor is UltiGCode!
-                if ";TweakAtZ-state" in line: #checks for state change comment
-                    state = self.getValue(line, ";TweakAtZ-state", state)
-                if ";TweakAtZ instances:" in line:
-                    try:
-                        tempTWi = int(line[20:])
-                    except:
-                        tempTWi = TWinstances
-                    TWinstances = tempTWi
-                if ";Small layer" in line: #checks for begin of Cool Head Lift
-                    old["state"] = state
-                    state = 0
-                if ";LAYER:" in line: #new layer no. found
-                    if state == 0:
-                        state = old["state"]
-                    layer = self.getValue(line, ";LAYER:", layer)
-                    if targetL_i > -100000: #target selected by layer no.
-                        if (state == 2 or targetL_i == 0) and layer == targetL_i: #determine targetZ from layer no.; checks for tweak on layer 0
-                            state = 2
-                            targetZ = z + 0.001
-                if (self.getValue(line, "T", None) is not None) and (self.getValue(line, "M", None) is None): #looking for single T-cmd
-                    pres_ext = self.getValue(line, "T", pres_ext)
-                if "M190" in line or "M140" in line and state < 3: #looking for bed temp, stops after target z is passed
-                    old["bedTemp"] = self.getValue(line, "S", old["bedTemp"])
-                if "M109" in line or "M104" in line and state < 3: #looking for extruder temp, stops after target z is passed
-                    if self.getValue(line, "T", pres_ext) == 0:
-                        old["extruderOne"] = self.getValue(line, "S", old["extruderOne"])
-                    elif self.getValue(line, "T", pres_ext) == 1:
-                        old["extruderTwo"] = self.getValue(line, "S", old["extruderTwo"])
-                if "M107" in line: #fan is stopped; is always updated in order not to miss switch off for next object
-                    old["fanSpeed"] = 0
-                if "M106" in line and state < 3: #looking for fan speed
-                    old["fanSpeed"] = self.getValue(line, "S", old["fanSpeed"])
-                if "M221" in line and state < 3: #looking for flow rate
-                    tmp_extruder = self.getValue(line,"T",None)
-                    if tmp_extruder == None: #check if extruder is specified
-                        old["flowrate"] = self.getValue(line, "S", old["flowrate"])
-                    elif tmp_extruder == 0: #first extruder
-                        old["flowrateOne"] = self.getValue(line, "S", old["flowrateOne"])
-                    elif tmp_extruder == 1: #second extruder
-                        old["flowrateOne"] = self.getValue(line, "S", old["flowrateOne"])
-                if ("M84" in line or "M25" in line):
-                    if state>0 and TweakProp["speed"]: #"finish" commands for UM Original and UM2
-                        modified_gcode += "M220 S100 ; speed reset to 100% at the end of print\n"
-                        modified_gcode += "M117                     \n"
-                    modified_gcode += line + "\n"
-                if "G1" in line or "G0" in line:
-                    newZ = self.getValue(line, "Z", z)
-                    x = self.getValue(line, "X", None)
-                    y = self.getValue(line, "Y", None)
-                    e = self.getValue(line, "E", None)
-                    f = self.getValue(line, "F", None)
-                    if 'G1' in line and TweakPrintSpeed and (state==3 or state==4):
-                        # check for pure print movement in target range:
-                        if x != None and y != None and f != None and e != None and newZ==z:
-                            modified_gcode += "G1 F%d X%1.3f Y%1.3f E%1.5f\n" % (int(f/100.0*float(printspeed)),self.getValue(line,"X"),
-                                                                          self.getValue(line,"Y"),self.getValue(line,"E"))
-                        else: #G1 command but not a print movement
-                            modified_gcode += line + "\n"
-                    # no tweaking on retraction hops which have no x and y coordinate:
-                    if (newZ != z) and (x is not None) and (y is not None):
-                        z = newZ
-                        if z < targetZ and state == 1:
-                            state = 2
-                        if z >= targetZ and state == 2:
-                            state = 3
-                            done_layers = 0
-                            for key in TweakProp:
-                                if TweakProp[key] and old[key]==-1: #old value is not known
-                                    oldValueUnknown = True
-                            if oldValueUnknown: #the tweaking has to happen within one layer
-                                twLayers = 1
-                                if IsUM2: #Parameters have to be stored in the printer (UltiGCode=UM2)
-                                    modified_gcode += "M605 S%d;stores parameters before tweaking\n" % (TWinstances-1)
-                            if behavior == 1: #single layer tweak only and then reset
-                                twLayers = 1
-                            if TweakPrintSpeed and behavior == 0:
-                                twLayers = done_layers + 1
-                        if state==3:
-                            if twLayers-done_layers>0: #still layers to go?
-                                if targetL_i > -100000:
-                                    modified_gcode += ";TweakAtZ V%s: executed at Layer %d\n" % (self.version,layer)
-                                    modified_gcode += "M117 Printing... tw@L%4d\n" % layer
-                                else:
-                                    modified_gcode += (";TweakAtZ V%s: executed at %1.2f mm\n" % (self.version,z))
-                                    modified_gcode += "M117 Printing... tw@%5.1f\n" % z
-                                for key in TweakProp:
-                                    if TweakProp[key]:
-                                        modified_gcode += TweakStrings[key] % float(old[key]+(float(target_values[key])-float(old[key]))/float(twLayers)*float(done_layers+1))
-                                done_layers += 1
-                            else:
-                                state = 4
-                                if behavior == 1: #reset values after one layer
-                                    if targetL_i > -100000:
-                                        modified_gcode += ";TweakAtZ V%s: reset on Layer %d\n" % (self.version,layer)
-                                    else:
-                                        modified_gcode += ";TweakAtZ V%s: reset at %1.2f mm\n" % (self.version,z)
-                                    if IsUM2 and oldValueUnknown: #executes on UM2 with Ultigcode and machine setting
-                                        modified_gcode += "M606 S%d;recalls saved settings\n" % (TWinstances-1)
-                                    else: #executes on RepRap, UM2 with Ultigcode and Cura setting
-                                        for key in TweakProp:
-                                            if TweakProp[key]:
-                                                modified_gcode += TweakStrings[key] % float(old[key])
-                        # re-activates the plugin if executed by pre-print G-command, resets settings:
-                        if (z < targetZ or layer == 0) and state >= 3: #resets if below tweak level or at level 0
-                            state = 2
-                            done_layers = 0
-                            if targetL_i > -100000:
-                                modified_gcode += ";TweakAtZ V%s: reset below Layer %d\n" % (self.version,targetL_i)
-                            else:
-                                modified_gcode += ";TweakAtZ V%s: reset below %1.2f mm\n" % (self.version,targetZ)
-                            if IsUM2 and oldValueUnknown: #executes on UM2 with Ultigcode and machine setting
-                                modified_gcode += "M606 S%d;recalls saved settings\n" % (TWinstances-1)
-                            else: #executes on RepRap, UM2 with Ultigcode and Cura setting
-                                for key in TweakProp:
-                                    if TweakProp[key]:
-                                        modified_gcode += TweakStrings[key] % float(old[key])
-            data[index] = modified_gcode
-            index += 1
-        return data
+            self.targetL_i = -100000
+            self.targetZ = getSettingValueByKey("b_targetZ")
+
+    def snapshot(self):
+        values = [getattr(self, name) for name in self.carried]
+        values[0] = dict(values[0]) #old
+        return values
+
+    def restore(self, snapshot):
+        for name, value in zip(self.carried, snapshot):
+            setattr(self, name, value)
+        self.old = dict(self.old) #a snapshot may be restored more than once
+
+    ## The tokens of the lines which can change the state (see scanLines): the keys of the handlers, a Z for the moves
+    @classmethod
+    def getStateTokens(cls):
+        return frozenset("Z" if key in cls.moves else key for key in cls.handlers)
+
+    ## The tokens of the lines which may change the G-code in front of the target: the keys of the handlers which
+    #  aren't clean, and the comments of other TweakAtZ instances (see LayerIndex)
+    @classmethod
+    def getUncleanTokens(cls):
+        return frozenset(key for key in cls.handlers if key not in cls.clean) | frozenset([";TweakAtZ"])
+
+    ## Height from which on the processor may change the G-code (see LayerIndex)
+    def getTargetZ(self):
+        return self.targetZ
+
+    ## True if the processor may change the G-code from the layer with the given marker on (see LayerIndex)
+    def isTargetLayer(self, marker):
+        return marker == self.targetL_i
+
+    ## lines: the result of scanLines for active_layer, if it is already known
+    def processLayer(self, active_layer, lines = None):
+        if lines is None and not self.rewritesMoves():
+            lines = scanLines(active_layer, self._state_token)
+        if self.passLayer(lines):
+            return active_layer #pass-through, the layer is unchanged
+        return self.rebuildLayer(active_layer)
+
+    ## True while the print moves get rewritten (print speed tweak in the tweak range)
+    def rewritesMoves(self):
+        return self.TweakPrintSpeed and (self.state == 3 or self.state == 4)
+
+    ## Advances the state over a layer by its state-changing lines and returns True, if the layer passes unchanged;
+    #  otherwise the state stays as it was and the layer has to be rebuilt (see rebuildLayer)
+    def passLayer(self, lines):
+        if self.rewritesMoves():
+            return False
+        start = self.snapshot()
+        if self.scanLayer(lines) is None:
+            return True
+        self.restore(start)
+        return False
+
+    ## Advances the state over a layer by its state-changing lines only (see scanLines), without rebuilding it.
+    #  Returns None if the layer stays unchanged, otherwise the output of these lines (the other lines of the
+    #  layer are plain moves without Z; they stay or become such moves).
+    def scanLayer(self, lines):
+        print_moves = self.rewritesMoves()
+        modified_gcode = []
+        self.processLines(lines, modified_gcode)
+        if modified_gcode == [line + "\n" for line in lines] and not (self.TweakPrintSpeed and (print_moves or
+                self.state == 3 or self.state == 4 or any(";TweakAtZ-state" in line for line in lines))):
+            return None
+        return modified_gcode
+
+    def rebuildLayer(self, active_layer):
+        if self.TweakPrintSpeed:
+            return self.rebuildMovesLayer(active_layer)
+        chunks = [] #the layer is rebuilt slice by slice, so only one slice is held as single lines and pieces
+        for lines in splitLines(active_layer):
+            modified_gcode = []
+            self.processLines(lines, modified_gcode)
+            chunks.append("".join(modified_gcode))
+        chunks[-1] = chunks[-1][:-1] #the last piece of the layer has no line end of its own
+        return "".join(chunks)
+
+    ## Like rebuildLayer, but returns the changes of the layer only, as records (line offset, text, removed): at the
+    #  line offset (as of active_layer.split("\n")), the given no. of lines is replaced by text (see applyRecords)
+    def patchLayer(self, active_layer):
+        records = []
+        line_no = 0
+        position = 0
+        for start, end in iterStateLines(active_layer, self._state_token):
+            self.patchSegment(active_layer[position:start], line_no, records)
+            line_no += active_layer.count("\n", position, start)
+            line = active_layer[start:end]
+            modified_gcode = []
+            self.processLines([line], modified_gcode)
+            if line + "\n" in modified_gcode: #the line stays, with lines inserted in front of and/or after it
+                echo = modified_gcode.index(line + "\n")
+                if echo > 0:
+                    records.append((line_no, "".join(modified_gcode[:echo]), 0))
+                if echo + 1 < len(modified_gcode):
+                    records.append((line_no + 1, "".join(modified_gcode[echo + 1:]), 0))
+            else:
+                records.append((line_no, "".join(modified_gcode), 1))
+            line_no += 1
+            position = end + 1
+        self.patchSegment(active_layer[position:], line_no, records)
+        return records
+
+    ## Adds a record for the plain moves between two state-changing lines, if they are rewritten (see patchLayer)
+    def patchSegment(self, text, line_no, records):
+        modified_text = self.rewriteSegment(text)
+        if modified_text != text:
+            removed = text.count("\n")
+            if not text.endswith("\n"): #the last line of the layer
+                removed += 1
+                modified_text += "\n"
+            records.append((line_no, modified_text, removed))
+
+    ## Rebuilds a layer with the print speed tweak: only the state-changing lines (see iterStateLines) run through
+    #  the state machine line by line; the plain moves in between are copied or, in the tweak range, rewritten in bulk.
+    def rebuildMovesLayer(self, active_layer):
+        chunks = []
+        position = 0
+        for start, end in iterStateLines(active_layer, self._state_token):
+            chunks.append(self.rewriteSegment(active_layer[position:start]))
+            modified_gcode = []
+            self.processLines([active_layer[start:end]], modified_gcode)
+            if end == len(active_layer): #the last line of the layer has no line end of its own
+                modified_gcode[-1] = modified_gcode[-1][:-1]
+            chunks.append("".join(modified_gcode))
+            position = end + 1
+        chunks.append(self.rewriteSegment(active_layer[position:]))
+        return "".join(chunks)
+
+    ## Rewrites the plain moves between two state-changing lines (in slices of roughly size characters)
+    def rewriteSegment(self, text, size = 65536):
+        if not self.rewritesMoves() or "G1" not in text:
+            return text
+        chunks = []
+        start = 0
+        while True:
+            end = text.find("\n", start + size)
+            if end == -1:
+                chunks.append(self.rewriteMoves(text[start:])[0])
+                return "".join(chunks)
+            chunks.append(self.rewriteMoves(text[start:end + 1])[0])
+            start = end + 1
+
+    ## Rewrites the print moves of plain G-code without state-changing lines in one go, as processLines would do
+    #  it line by line: the moves are split off by a regex, their feedrates are scaled together and the
+    #  new lines are formatted in bulk. Returns the text and the no. of rewritten moves.
+    def rewriteMoves(self, text):
+        parts = _PRINT_MOVE.split(text) #the text between the moves, then the 5 groups of each move, and so on
+        if len(parts) == 1:
+            return text, 0
+        others = parts[5::6] #G1 lines not written as Cura does, None for the moves written as Cura does
+        if any(other is not None for other in others):
+            moves = [index * 6 for index, other in enumerate(others) if other is None]
+            columns = [[parts[move + group] for move in moves] for group in (1, 2, 3, 4)]
+        else:
+            columns = [parts[group::6] for group in (1, 2, 3, 4)]
+        feedrates, xs, ys, es = [list(map(float, column)) for column in columns]
+        speed = float(self.printspeed)
+        feedrates = [int(f / 100.0 * speed) for f in feedrates]
+        rewritten = list(map(_PRINT_MOVE_FORMAT.__mod__, zip(feedrates, xs, ys, es)))
+        count = len(rewritten)
+        if count == len(others):
+            replacements = rewritten
+        else:
+            rewritten.reverse()
+            replacements = [rewritten.pop() if other is None else self.rewriteMove(other) for other in others]
+            count += sum(1 for other, replacement in zip(others, replacements)
+                         if other is not None and replacement is not other)
+        pieces = [None] * (len(others) * 2 + 1)
+        pieces[0::2] = parts[0::6]
+        pieces[1::2] = replacements
+        return "".join(pieces), count
+
+    ## Rewrites a single G1 line without Z as processLines would do it in the tweak range of the print speed tweak
+    def rewriteMove(self, line, gline = None):
+        if gline is None:
+            gline = self.parseMove(line)
+        x = gline.getValue("X")
+        y = gline.getValue("Y")
+        e = gline.getValue("E")
+        f = gline.getValue("F")
+        if x != None and y != None and f != None and e != None:
+            return _PRINT_MOVE_FORMAT % (int(f/100.0*float(self.printspeed)),x,y,e)
+        return line
+
+    ## Runs lines through the state machine: each line goes to at most one handler, found by its command word or,
+    #  for a comment line, by its tag (see handlers); a line without handler is passed on as it is.
+    def processLines(self, lines, modified_gcode):
+        dispatch = self._dispatch
+        command_word = _COMMAND_WORD.match
+        comment_tag = self._comment_tag.match
+        for line in lines:
+            first = line[:1]
+            if first in _COMMAND_LETTERS:
+                m = command_word(line)
+            elif first == ";":
+                m = comment_tag(line)
+            else:
+                m = None
+            if m is not None:
+                word = m.group(0)
+                handler = dispatch.get(word)
+                if handler is not None:
+                    handler(self, word, line, modified_gcode)
+                    continue
+            modified_gcode.append(line + "\n")
+
+    def handleGenerated(self, word, line, modified_gcode):
+        self.TWinstances += 1
+        modified_gcode.append(";TweakAtZ instances: %d\n" % self.TWinstances)
+        modified_gcode.append(line + "\n")
+
+    def handleFlavor(self, word, line, modified_gcode): #Flavor is UltiGCode!
+        self.IsUM2 = True
+        modified_gcode.append(line + "\n")
+
+    def handleState(self, word, line, modified_gcode): #state change comment
+        self.state = self.parseLine(line).getValue(";TweakAtZ-state", self.state)
+        modified_gcode.append(line + "\n")
+
+    def handleInstances(self, word, line, modified_gcode): #written by another instance; replaced with an updated one
+        try:
+            self.TWinstances = int(line[20:])
+        except:
+            pass
+
+    def handleSmallLayer(self, word, line, modified_gcode): #begin of Cool Head Lift
+        self.old["state"] = self.state
+        self.state = 0
+        modified_gcode.append(line + "\n")
+
+    def handleLayer(self, word, line, modified_gcode): #new layer no. found
+        modified_gcode.append(line + "\n")
+        if self.state == 0:
+            self.state = self.old["state"]
+        self.layer = self.parseLine(line).getValue(";LAYER:", self.layer)
+        if self.targetL_i > -100000: #target selected by layer no.
+            #determine targetZ from layer no.; checks for tweak on layer 0
+            if (self.state == 2 or self.targetL_i == 0) and self.layer == self.targetL_i:
+                self.state = 2
+                self.targetZ = self.z + 0.001
+
+    def handleTool(self, word, line, modified_gcode): #single T-cmd
+        modified_gcode.append(line + "\n")
+        gline = self.parseLine(line)
+        if gline.params.get("T") and not gline.params.get("M"):
+            self.pres_ext = gline.getValue("T", self.pres_ext)
+
+    def handleBedTemp(self, word, line, modified_gcode): #M140 stops after target z is passed
+        modified_gcode.append(line + "\n")
+        if word == "M190" or self.state < 3:
+            self.old["bedTemp"] = self.parseLine(line).getValue("S", self.old["bedTemp"])
+
+    def handleExtruderTemp(self, word, line, modified_gcode): #M104 stops after target z is passed
+        modified_gcode.append(line + "\n")
+        if word == "M109" or self.state < 3:
+            gline = self.parseLine(line)
+            extruder = gline.getValue("T", self.pres_ext)
+            if extruder == 0:
+                self.old["extruderOne"] = gline.getValue("S", self.old["extruderOne"])
+            elif extruder == 1:
+                self.old["extruderTwo"] = gline.getValue("S", self.old["extruderTwo"])
+
+    def handleFan(self, word, line, modified_gcode):
+        modified_gcode.append(line + "\n")
+        if word == "M107": #fan is stopped; is always updated in order not to miss switch off for next object
+            self.old["fanSpeed"] = 0
+        elif self.state < 3:
+            self.old["fanSpeed"] = self.parseLine(line).getValue("S", self.old["fanSpeed"])
+
+    def handleFlowrate(self, word, line, modified_gcode):
+        modified_gcode.append(line + "\n")
+        if self.state < 3:
+            gline = self.parseLine(line)
+            old = self.old
+            tmp_extruder = gline.getValue("T")
+            if tmp_extruder == None: #check if extruder is specified
+                old["flowrate"] = gline.getValue("S", old["flowrate"])
+            elif tmp_extruder == 0: #first extruder
+                old["flowrateOne"] = gline.getValue("S", old["flowrateOne"])
+            elif tmp_extruder == 1: #second extruder
+                old["flowrateOne"] = gline.getValue("S", old["flowrateOne"])
+
+    def handleEnd(self, word, line, modified_gcode): #"finish" commands for UM Original and UM2
+        if self.state > 0 and self.TweakProp["speed"]:
+            modified_gcode.append("M220 S100 ; speed reset to 100% at the end of print\n")
+            modified_gcode.append("M117                     \n")
+        modified_gcode.append(line + "\n")
+
+    def handleMove(self, word, line, modified_gcode):
+        state = self.state
+        print_move = word[-1] == "1" and self.TweakPrintSpeed and (state == 3 or state == 4)
+        if not print_move:
+            modified_gcode.append(line + "\n")
+            if "Z" not in line: #the plain moves stay at their Z
+                return
+        gline = self.parseMove(line)
+        z = self.z
+        newZ = gline.getValue("Z", z)
+        if print_move: # check for pure print movement in target range:
+            modified_gcode.append((self.rewriteMove(line, gline) if newZ == z else line) + "\n")
+        x = gline.getValue("X")
+        y = gline.getValue("Y")
+        # no tweaking on retraction hops which have no x and y coordinate:
+        if newZ == z or x is None or y is None:
+            return
+        old = self.old
+        z = self.z = newZ
+        if z < self.targetZ and state == 1:
+            state = 2
+        if z >= self.targetZ and state == 2:
+            state = 3
+            self.done_layers = 0
+            if self.plan.isOldValueUnknown(old):
+                self.oldValueUnknown = True
+            if self.oldValueUnknown: #the tweaking has to happen within one layer
+                self.twLayers = 1
+                if self.IsUM2: #Parameters have to be stored in the printer (UltiGCode=UM2)
+                    modified_gcode.append("M605 S%d;stores parameters before tweaking\n" % (self.TWinstances-1))
+            if self.behavior == 1: #single layer tweak only and then reset
+                self.twLayers = 1
+            if self.TweakPrintSpeed and self.behavior == 0:
+                self.twLayers = self.done_layers + 1
+        if state==3:
+            if self.twLayers-self.done_layers>0: #still layers to go?
+                if self.targetL_i > -100000:
+                    modified_gcode.append(";TweakAtZ V%s: executed at Layer %d\n" % (self.version,self.layer))
+                    modified_gcode.append("M117 Printing... tw@L%4d\n" % self.layer)
+                else:
+                    modified_gcode.append(";TweakAtZ V%s: executed at %1.2f mm\n" % (self.version,z))
+                    modified_gcode.append("M117 Printing... tw@%5.1f\n" % z)
+                modified_gcode.extend(self.plan.getStep(old, self.twLayers, self.done_layers))
+                self.done_layers += 1
+            else:
+                state = 4
+                if self.behavior == 1: #reset values after one layer
+                    if self.targetL_i > -100000:
+                        modified_gcode.append(";TweakAtZ V%s: reset on Layer %d\n" % (self.version,self.layer))
+                    else:
+                        modified_gcode.append(";TweakAtZ V%s: reset at %1.2f mm\n" % (self.version,z))
+                    self.resetValues(modified_gcode)
+        # re-activates the plugin if executed by pre-print G-command, resets settings:
+        if (z < self.targetZ or self.layer == 0) and state >= 3: #resets if below tweak level or at level 0
+            state = 2
+            self.done_layers = 0
+            if self.targetL_i > -100000:
+                modified_gcode.append(";TweakAtZ V%s: reset below Layer %d\n" % (self.version,self.targetL_i))
+            else:
+                modified_gcode.append(";TweakAtZ V%s: reset below %1.2f mm\n" % (self.version,self.targetZ))
+            self.resetValues(modified_gcode)
+        self.state = state
+
+    def resetValues(self, modified_gcode):
+        if self.IsUM2 and self.oldValueUnknown: #executes on UM2 with Ultigcode and machine setting
+            modified_gcode.append("M606 S%d;recalls saved settings\n" % (self.TWinstances-1))
+        else: #executes on RepRap, UM2 with Ultigcode and Cura setting
+            modified_gcode.extend(self.plan.getReset(self.old))
+
+## The state machine of a Schedule: a TweakProcessor without tweaks of its own (it keeps track of the layers, the height
+#  and the cool head lift as TweakAtZ does), which writes the scheduled values at each layer boundary: after the
+#  ";LAYER:" markers for a schedule by layer no., after each change of height (as TweakAtZ triggers, so not on
+#  retraction hops) for one by height. A value is only written if it differs from the one written before.
+#  It's not counted as TweakAtZ instance, as it never stores or recalls values on the printer.
+class ScheduleProcessor(TweakProcessor):
+    carried = TweakProcessor.carried + ("last",)
+    handlers = dict((key, name) for key, name in TweakProcessor.handlers.items()
+                    if key not in (";Generated with Cura_SteamEngine", ";TweakAtZ instances:"))
+
+    def __init__(self, getSettingValueByKey, version, schedule):
+        super(ScheduleProcessor, self).__init__(getSettingValueByKey, version)
+        self.schedule = schedule
+        self.last = {} #line last written per parameter
+
+    def snapshot(self):
+        values = TweakProcessor.snapshot(self)
+        values[-1] = dict(values[-1]) #last
+        return values
+
+    def restore(self, snapshot):
+        TweakProcessor.restore(self, snapshot)
+        self.last = dict(self.last)
+
+    def getTargetZ(self):
+        return self.schedule.first if self.schedule.trigger == "height" else float("inf")
+
+    def isTargetLayer(self, marker):
+        return self.schedule.trigger == "layer_no" and marker is not None and marker >= self.schedule.first
+
+    def handleLayer(self, word, line, modified_gcode):
+        TweakProcessor.handleLayer(self, word, line, modified_gcode)
+        if self.schedule.trigger == "layer_no" and self.state > 0:
+            self.applySchedule(self.layer, modified_gcode)
+
+    def handleMove(self, word, line, modified_gcode):
+        z = self.z
+        TweakProcessor.handleMove(self, word, line, modified_gcode)
+        if self.z != z and self.schedule.trigger == "height" and self.state > 0 and self.layer > -100000:
+            self.applySchedule(self.z, modified_gcode)
+
+    def applySchedule(self, position, modified_gcode):
+        last = self.last
+        lines = []
+        for key, value in self.schedule.getValues(position):
+            line = self.TweakStrings[key] % value
+            if last.get(key) != line:
+                last[key] = line
+                lines.append(line)
+        if lines:
+            if self.schedule.trigger == "layer_no":
+                modified_gcode.append(";TweakAtZ V%s: schedule at Layer %d\n" % (self.version, self.layer))
+            else:
+                modified_gcode.append(";TweakAtZ V%s: schedule at %1.2f mm\n" % (self.version, self.z))
+            modified_gcode.extend(lines)
+
+#the regex of scanLines for TweakProcessor (see getStateToken)
+_STATE_TOKEN = compileTokens(TweakProcessor.getStateTokens())
+
+## The regex of scanLines for a chain of processors: it finds the lines of the handlers of all of them
+def getStateToken(processors):
+    return compileTokens(frozenset().union(*(processor.getStateTokens() for processor in processors)))
+
+## Runs the layers through a chain of state machines (one per stacked TweakAtZ entry) in a single pass and yields
+#  the results. The scan of a layer is shared by the state machines as long as none of them changes the layer.
+#  (index: LayerIndex to record the layers in as they go by, see LayerIndex.addLayer; start: position of the first
+#  layer in the data)
+def processLayers(processors, layers, index = None, start = 0):
+    token = getStateToken(processors)
+    for position, active_layer in enumerate(layers, start):
+        lines = None
+        if index is not None and index.recording:
+            lines = scanLines(active_layer, token)
+            index.addLayer(position, active_layer, lines, processors)
+        for processor in processors:
+            if lines is None:
+                lines = scanLines(active_layer, token)
+            modified_layer = processor.processLayer(active_layer, lines)
+            if modified_layer is not active_layer:
+                active_layer = modified_layer
+                lines = None
+        yield active_layer
+
+## Two-phase variant of processLayers for a list of layers, using several processes. The first phase scans all
+#  layers (as scanLayer does) and records the carried state at the start of each range of layers. The second phase
+#  rebuilds the ranges with changes independently in a process pool. The result is identical to processLayers.
+#  (timings: dictionary to record the time of both phases in, if given)
+def processLayersParallel(processors, data, workers, timings = None):
+    import concurrent.futures
+    start = time.perf_counter()
+    ranges = [] #[first layer, snapshots of the processors, no. of layers, changed]
+    token = getStateToken(processors)
+    range_size = max(sum(len(active_layer) for active_layer in data) // (workers * 4), 1)
+    size = range_size
+    for active_layer in data:
+        if size >= range_size:
+            ranges.append([ranges[-1][0] + ranges[-1][2] if ranges else 0,
+                           [processor.snapshot() for processor in processors], 0, False])
+            size = 0
+        size += len(active_layer)
+        ranges[-1][2] += 1
+        lines = scanLines(active_layer, token)
+        for processor in processors:
+            modified_gcode = processor.scanLayer(lines)
+            if modified_gcode is not None:
+                ranges[-1][3] = True
+                lines = scanLines("".join(modified_gcode), token) #input of the next processor in the chain
+    if timings is not None:
+        timings["parallel_scan"] = time.perf_counter() - start
+        start = time.perf_counter()
+    results = list(data)
+    changed = [(first, snapshots, data[first:first + count]) for first, snapshots, count, change in ranges if change]
+    try:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            futures = [executor.submit(processRange, processors, snapshots, layers) for first, snapshots, layers in changed]
+            for (first, snapshots, layers), future in zip(changed, futures):
+                results[first:first + len(layers)] = future.result()
+    except Exception: #no processes available (or the classes can't be pickled in this environment): go sequential
+        for first, snapshots, layers in changed:
+            results[first:first + len(layers)] = processRange(processors, snapshots, layers)
+    if timings is not None:
+        timings["parallel_rebuild"] = time.perf_counter() - start
+    return results
+
+## TweakProcessor which counts and times its work in self.stats (for TweakAtZ.execute with instrument).
+#  It's a subclass, so the plain TweakProcessor only has the parseLine/parseMove hooks. Only the pass of a layer which
+#  is kept counts (a trial scan before a rebuild is rolled back, see passLayer). In the parallel mode, the counters only
+#  cover the work done in the calling process (the scan); the rebuild in the pool shows up in the phase timings.
+class InstrumentedProcessor(TweakProcessor):
+    def __init__(self, getSettingValueByKey, version):
+        TweakProcessor.__init__(self, getSettingValueByKey, version)
+        self.stats = {"lines_scanned": 0, #lines of all layers
+                      "lines_parsed": 0, #lines tokenized by the handlers (see parseLine)
+                      "moves_parsed": 0, #G0/G1 moves among them (see parseMove)
+                      "moves_rewritten": 0, #print moves rewritten by the print speed tweak
+                      "lines_inserted": 0, #lines added by the tweak (less the replaced ";TweakAtZ instances" lines)
+                      "layers_passed": 0, "layers_rebuilt": 0,
+                      "layers_per_state": [0, 0, 0, 0, 0], #state at the end of each layer
+                      "time_scan": 0.0, "time_rebuild": 0.0,
+                      "layer_times": []}
+
+    def processLayer(self, active_layer, lines = None):
+        self.stats["lines_scanned"] += active_layer.count("\n") + 1
+        return TweakProcessor.processLayer(self, active_layer, lines)
+
+    #the stats counted by the lines a layer runs through (see processLines, parseLine)
+    counters = ("lines_parsed", "moves_parsed", "moves_rewritten", "lines_inserted")
+
+    #each layer goes through passLayer and, if it isn't passed, through rebuildLayer
+    def passLayer(self, lines):
+        stats = self.stats
+        counts = [stats[key] for key in self.counters]
+        start = time.perf_counter()
+        passed = TweakProcessor.passLayer(self, lines)
+        duration = time.perf_counter() - start
+        stats["layer_times"].append(duration)
+        stats["time_scan"] += duration
+        if passed:
+            stats["layers_passed"] += 1
+            self.countState()
+        else: #rolled back like the state; rebuildLayer runs the lines again, only that pass counts
+            stats.update(zip(self.counters, counts))
+        return passed
+
+    def rebuildLayer(self, active_layer):
+        stats = self.stats
+        start = time.perf_counter()
+        modified_layer = TweakProcessor.rebuildLayer(self, active_layer)
+        duration = time.perf_counter() - start
+        stats["layer_times"][-1] += duration
+        stats["time_rebuild"] += duration
+        stats["layers_rebuilt"] += 1
+        self.countState()
+        return modified_layer
+
+    def countState(self): #state at the end of a layer
+        if 0 <= self.state <= 4:
+            self.stats["layers_per_state"][int(self.state)] += 1
+
+    def rewriteMoves(self, text):
+        text, count = TweakProcessor.rewriteMoves(self, text)
+        self.stats["moves_rewritten"] += count
+        return text, count
+
+    def parseLine(self, line):
+        self.stats["lines_parsed"] += 1
+        return parseLine(line)
+
+    def parseMove(self, line):
+        self.stats["moves_parsed"] += 1
+        return self.parseLine(line)
+
+    def processLines(self, lines, modified_gcode):
+        count = len(modified_gcode)
+        TweakProcessor.processLines(self, lines, modified_gcode)
+        stats = self.stats
+        stats["lines_inserted"] += len(modified_gcode) - count - len(lines) #one piece per line
+        if self.TweakPrintSpeed:
+            unchanged = set(line + "\n" for line in lines)
+            stats["moves_rewritten"] += sum(1 for piece in modified_gcode[count:] if piece.startswith("G1 F") and
+                                            piece not in unchanged)
+
+class InstrumentedScheduleProcessor(ScheduleProcessor, InstrumentedProcessor):
+    pass
+
+## Collects the stats of instrumented processors into a report: totals over all processors, the stats of each one
+#  and the timings (total, per phase, per layer)
+def buildReport(processors, duration, timings = None):
+    report = {"time_total": duration, "processors": [processor.stats for processor in processors]}
+    for key, value in processors[0].stats.items():
+        if key == "layers_per_state":
+            report[key] = [sum(processor.stats[key][state] for processor in processors) for state in range(5)]
+        elif key != "layer_times":
+            report[key] = sum(processor.stats[key] for processor in processors)
+    report.update(timings or {})
+    return report
+
+## Formats a report as summary comment for the end of the G-code
+def formatReport(report, version):
+    return (";TweakAtZ V%s report: %d lines scanned, %d parsed (%d moves), %d moves rewritten, %d layers passed, "
+            "%d rebuilt, layers per state %s, %.3f s (scan %.3f s, rebuild %.3f s)\n" % (version,
+            report["lines_scanned"], report["lines_parsed"], report["moves_parsed"], report["moves_rewritten"],
+            report["layers_passed"], report["layers_rebuilt"], "/".join(str(count) for count in report["layers_per_state"]),
+            report["time_total"], report["time_scan"], report["time_rebuild"]))
+
+## Processes a range of layers, starting from the given states of the processors (a job of processLayersParallel)
+def processRange(processors, snapshots, layers):
+    for processor, snapshot in zip(processors, snapshots):
+        processor.restore(snapshot)
+    return list(processLayers(processors, layers))
+
+## Reads G-code in blocks and yields it in chunks of whole lines, which start at the lines with the ";LAYER:" markers.
+#  A chunk is cut after about max_size characters at the latest, so even a huge single layer is never held at once.
+#  (marker has to be b";LAYER:" for a file opened in binary mode)
+def readLayers(gcode_file, max_size = 1 << 20, marker = ";LAYER:"):
+    newline = "\n" if isinstance(marker, str) else b"\n"
+    separator = newline + marker
+    pending = marker[:0]
+    while True:
+        block = gcode_file.read(max_size)
+        pending += block
+        start = 0
+        while True:
+            position = pending.find(separator, start)
+            if position == -1:
+                break
+            yield pending[start:position + 1]
+            start = position + 1
+        pending = pending[start:]
+        if not block:
+            if pending:
+                yield pending
+            return
+        if len(pending) > max_size: #no marker for a while: cut at the last complete line
+            cut = pending.rfind(newline) + 1
+            if cut > 0:
+                yield pending[:cut]
+                pending = pending[cut:]
+
+#G-code files are read and written as bytes; this decoding keeps any byte of them as it is
+_ENCODING = "utf-8"
+_ERRORS = "surrogateescape"
+
+#extensions of compressed G-code files
+_COMPRESSED = (".gz", ".zst")
+
+## Opens a G-code file in binary mode ("rb" or "wb"). A file ending with .gz (gzip) or .zst (zstd, needs the zstandard
+#  module) is decompressed or compressed as a stream, block by block, as it is read or written.
+#  (name: the file name which tells the compression, if it isn't the one of path)
+def openGCode(path, mode = "rb", name = None):
+    name = (name or path).lower()
+    if name.endswith(".gz"):
+        return gzip.open(path, mode, compresslevel = 6)
+    if name.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError("zstd compressed G-code needs the zstandard module: %s" % path)
+        return zstandard.open(path, mode)
+    return open(path, mode)
+
+#lines in layers which can't be skipped with a LayerIndex of a file: they (may) change the output or the instance count
+_UNCLEAN = compileTokens(TweakProcessor.getUncleanTokens())
+_Z_VALUE = re.compile(r"^G[01][^;\n]*Z(" + _NUMBER.pattern + ")", re.M)
+
+## Layer/Z index of a G-code file, saved as a sidecar file next to it (file name + extension). For each ";LAYER:"
+#  marker it holds [byte offset, layer no. of the marker, highest Z before it, clean, scan state]; the scan state is
+#  the carried state of TweakProcessor (Z, layer, active extruder, last seen bed and extruder temperatures, fan speed
+#  and flow rates, ...). "clean" tells that no layer since the first marker has lines which TweakAtZ may change.
+#  Later runs on the same file, at any height, use it to copy the layers in front of the tweak as they are.
+class LayerIndex(object):
+    version = 1
+    extension = ".tzidx"
+    #TWinstances is not restored; it's set in the header, which is always processed
+    restored = ("old", "pres_ext", "z", "layer", "state", "IsUM2")
+
+    def __init__(self, stamp, entries = None):
+        self.stamp = stamp
+        self.entries = entries or []
+        self._scanner = None
+        self._zmax = 0
+        self._clean = True
+        self.recording = True #for addLayer
+
+    ## Size and modification time of a file, to detect outdated index files
+    @staticmethod
+    def getStamp(path):
+        status = os.stat(path)
+        return [status.st_size, status.st_mtime_ns]
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path + cls.extension, "r") as index_file:
+                content = json.load(index_file)
+        except (OSError, ValueError):
+            return None
+        if content.get("version") != cls.version or content.get("stamp") != cls.getStamp(path):
+            return None #outdated or broken
+        return cls(content["stamp"], content["entries"])
+
+    def save(self, path):
+        with open(path + self.extension, "w") as index_file:
+            json.dump({"version": self.version, "stamp": self.stamp, "entries": self.entries}, index_file,
+                      separators = (",", ":"))
+
+    ## Adds a chunk of the file (as yielded by readLayers) at the given byte offset to the index
+    def add(self, offset, chunk):
+        self.addLines(offset, chunk.startswith(";LAYER:"), scanLines(chunk))
+
+    ## Adds a chunk of the file by its state-changing lines (see scanLines); marked: the chunk starts with a marker
+    def addLines(self, offset, marked, lines):
+        if self._scanner is None: #scans as TweakAtZ does, but never reaches a target
+            self._scanner = TweakAtZ().createProcessors([{"b_targetZ": float("inf")}])[0]
+        scanner = self._scanner
+        if marked: #the marker is a state-changing line itself, so it's the first of them
+            state = dict((name, getattr(scanner, name)) for name in self.restored)
+            state["old"] = dict(state["old"])
+            marker = parseLine(lines[0]).getValue(";LAYER:")
+            self.entries.append([offset, marker, self._zmax, self._clean, state])
+        text = "\n".join(lines) #the unclean lines are state-changing lines as well
+        if self.entries and _UNCLEAN.search(text):
+            self._clean = False
+        scanner.scanLayer(lines)
+        for value in _Z_VALUE.findall(text): #any Z of a move, also of hops (which TweakAtZ ignores)
+            self._zmax = max(self._zmax, float(value))
+
+    ## Adds a layer of a list of layers (see TweakAtZ.execute) at the given position, before the processors run
+    #  through it. Instead of a scanner of its own, the state of the processors is recorded; it is the same as the
+    #  one of a scanner as long as they are in front of their targets, so the recording stops there.
+    def addLayer(self, position, active_layer, lines, processors):
+        if active_layer.startswith(";LAYER:"):
+            if any(self._zmax >= processor.getTargetZ() for processor in processors):
+                self.recording = False
+                return
+            state = dict((name, getattr(processors[0], name)) for name in self.restored)
+            state["old"] = dict(state["old"])
+            marker = parseLine(active_layer[:active_layer.find("\n")]).getValue(";LAYER:")
+            self.entries.append([position, marker, self._zmax, True, state])
+            if any(processor.isTargetLayer(marker) for processor in processors): #the last entry in front of the target
+                self.recording = False
+                return
+        if self.entries:
+            text = "\n".join(lines)
+            if any(processor._unclean_token.search(text) for processor in processors):
+                self.recording = False
+                return
+            for value in _Z_VALUE.findall(text):
+                self._zmax = max(self._zmax, float(value))
+
+    ## Drops the given entry and all after it; the layers from there on are recorded again (see addLayer)
+    def truncate(self, entry):
+        position = self.entries.index(entry)
+        self._zmax = entry[2]
+        self.entries[position:] = []
+        self.recording = True
+
+    ## Returns the entry to continue at for the given processors (all layers in front of it are passed through by all
+    #  of them, as they are in front of the target), or None if there is nothing to skip
+    def findEntry(self, processors):
+        found = None
+        for position, entry in enumerate(self.entries):
+            offset, marker, zmax, clean, state = entry
+            if not clean or any(zmax >= processor.getTargetZ() for processor in processors):
+                break
+            if position > 0: #there's nothing to skip in front of the first layer
+                found = entry
+            if any(processor.isTargetLayer(marker) for processor in processors):
+                break
+        return found
+
+    def restore(self, processors, entry):
+        for processor in processors:
+            for name, value in entry[4].items():
+                setattr(processor, name, dict(value) if name == "old" else value)
+
+## Copies count bytes from one file to another in blocks
+def copyBytes(source, target, count, block_size = 1 << 20):
+    while count > 0:
+        block = source.read(min(block_size, count))
+        if not block:
+            break
+        target.write(block)
+        count -= len(block)
+
+## Writes a memoryview to a file in blocks, so a compressing file never gets more than a block at once (see openGCode)
+def writeBlocks(target, view, block_size = 1 << 20):
+    for position in range(0, len(view), block_size):
+        target.write(view[position:position + block_size])
+
+## Yields start and end of the chunks of a mapped G-code file from start on, cut as readLayers does
+def iterMappedLayers(buffer, start = 0, max_size = 1 << 20, marker = b"\n;LAYER:"):
+    size = len(buffer)
+    while start < size:
+        position = buffer.find(marker, start, start + max_size)
+        if position != -1:
+            end = position + 1
+        elif start + max_size >= size:
+            end = size
+        else: #no marker for a while: cut at the last complete line
+            end = buffer.rfind(b"\n", start, start + max_size) + 1
+            if end <= start: #a single line longer than max_size
+                end = buffer.find(b"\n", start + max_size) + 1 or size
+        yield start, end
+        start = end
+
+## scanLines for a chunk of a mapped G-code file: only the lines found are decoded
+#  (token: the regex of getStateToken, compiled for bytes)
+def scanMapped(buffer, start, end, token):
+    lines = []
+    search = token.search
+    position = start
+    while True:
+        m = search(buffer, position, end)
+        if m == None:
+            return lines
+        line_start = max(buffer.rfind(b"\n", start, m.start()) + 1, start)
+        line_end = buffer.find(b"\n", m.end(), end)
+        if line_end == -1:
+            line_end = end
+        lines.append(buffer[line_start:line_end].decode(_ENCODING, _ERRORS))
+        position = line_end + 1
+
+## Runs the chunks of a mapped G-code file from start on through the processors (as processLayers does) and writes
+#  the result to target. A chunk is only decoded when a processor changes it; the unchanged ones are written straight
+#  from the mapping, several in one go.
+#  (index: a new LayerIndex to add the chunks to; count_lines: for instrumented processors, see processLayer)
+def writeMappedLayers(processors, buffer, start, target, index = None, count_lines = False):
+    token = re.compile(getStateToken(processors).pattern.encode(_ENCODING))
+    with memoryview(buffer) as view:
+        unchanged = start #start of the unchanged chunks not written yet
+        for start, end in iterMappedLayers(buffer, start):
+            lines = scanMapped(buffer, start, end, token)
+            if index is not None:
+                index.addLines(start, buffer[start:start + 7] == b";LAYER:", lines)
+            active_layer = None
+            for processor in processors:
+                if active_layer is not None:
+                    active_layer = processor.processLayer(active_layer)
+                    continue
+                if count_lines:
+                    processor.stats["lines_scanned"] += view[start:end].tobytes().count(b"\n") + 1
+                if not processor.passLayer(lines):
+                    active_layer = processor.rebuildLayer(buffer[start:end].decode(_ENCODING, _ERRORS))
+            if active_layer is not None:
+                writeBlocks(target, view[unchanged:start])
+                target.write(active_layer.encode(_ENCODING, _ERRORS))
+                unchanged = end
+        writeBlocks(target, view[unchanged:])
+
+## Decodes the chunks of a G-code file and adds them to a new LayerIndex on the way (if there is one)
+def decodeChunks(chunks, offset = 0, index = None):
+    for chunk in chunks:
+        text = chunk.decode(_ENCODING, _ERRORS)
+        if index is not None:
+            index.add(offset, text)
+        offset += len(chunk)
+        yield text
+
+## Post-processes a G-code file with constant memory: the file is memory-mapped (see writeMappedLayers), or else
+#  read as a stream in chunks, and the result is written as it goes, layer by layer. Compressed files (see openGCode)
+#  are decompressed and compressed on the way, without an uncompressed copy on disk or in memory.
+#  (entries: list of settings dictionaries, see TweakAtZ.createProcessors)
+#  With use_index, a LayerIndex of the input file is used to jump straight to the layers in front of the tweak,
+#  or it is built and saved on the way, if there is none yet.
+#  With instrument, the report of the run is returned (see TweakAtZ.execute).
+def processFile(input_path, output_path, entries, use_index = False, instrument = False):
+    start = time.perf_counter()
+    processors = TweakAtZ().createProcessors(entries, instrument)
+    index = LayerIndex.load(input_path) if use_index else None
+    new_index = LayerIndex(LayerIndex.getStamp(input_path)) if use_index and index is None else None
+    part_path = output_path + ".part" #renamed when complete, so a failed run leaves no partial output behind
+    try:
+        with openGCode(input_path, "rb") as gcode_in:
+            buffer = None
+            if not input_path.lower().endswith(_COMPRESSED): #a compressed file is decompressed as a stream instead
+                try:
+                    buffer = mmap.mmap(gcode_in.fileno(), 0, access = mmap.ACCESS_READ)
+                except (OSError, ValueError): #e.g. an empty file, which can't be mapped
+                    pass
+            with openGCode(part_path, "wb", output_path) as gcode_out:
+                entry = index.findEntry(processors) if index is not None else None
+                if entry is not None: #the header is processed, the layers up to the entry are copied as they are
+                    header = gcode_in.read(index.entries[0][0]).decode(_ENCODING, _ERRORS)
+                    for active_layer in processLayers(processors, [header]):
+                        gcode_out.write(active_layer.encode(_ENCODING, _ERRORS))
+                    if buffer is None:
+                        copyBytes(gcode_in, gcode_out, entry[0] - index.entries[0][0])
+                    else:
+                        with memoryview(buffer) as view:
+                            writeBlocks(gcode_out, view[index.entries[0][0]:entry[0]])
+                    index.restore(processors, entry)
+                if buffer is not None:
+                    with buffer:
+                        writeMappedLayers(processors, buffer, entry[0] if entry is not None else 0, gcode_out,
+                                          new_index, instrument)
+                else:
+                    chunks = decodeChunks(readLayers(gcode_in, marker = b";LAYER:"), gcode_in.tell(), new_index)
+                    for active_layer in processLayers(processors, chunks):
+                        gcode_out.write(active_layer.encode(_ENCODING, _ERRORS))
+        os.replace(part_path, output_path)
+    except BaseException:
+        try:
+            os.remove(part_path)
+        except OSError:
+            pass
+        raise
+    if new_index is not None:
+        try:
+            new_index.save(input_path)
+        except OSError: #e.g. read-only folder; the index is an optimization only
+            pass
+    if instrument:
+        return buildReport(processors, time.perf_counter() - start)
+
+## Generator variant of processFile: reads the G-code file as a stream (also a compressed one, see openGCode) and
+#  yields the result as bytes, layer by layer, as soon as each one is done
+def iterFile(input_path, entries):
+    processors = TweakAtZ().createProcessors(entries)
+    with openGCode(input_path, "rb") as gcode_in:
+        for active_layer in processLayers(processors, decodeChunks(readLayers(gcode_in, marker = b";LAYER:"))):
+            yield active_layer.encode(_ENCODING, _ERRORS)
+
+## Applies a patch (see TweakAtZ.executePatch) to the layers it was made for and yields the resulting layers; only
+#  the layers with records are touched
+def applyPatch(layers, patch):
+    records = iter(patch)
+    record = next(records, None)
+    for index, active_layer in enumerate(layers):
+        layer_records = []
+        while record is not None and record[0] == index:
+            layer_records.append(record[1:])
+            record = next(records, None)
+        yield applyRecords(active_layer, layer_records) if layer_records else active_layer
+
+## Applies the records (line offset, text, removed) of a layer, in the order of their line offsets (see patchLayer)
+def applyRecords(active_layer, records):
+    lines = active_layer.split("\n")
+    pieces = []
+    position = 0 #the next line to copy
+    for line_no, text, removed in records:
+        if line_no > position:
+            pieces.append("\n".join(lines[position:line_no]) + "\n")
+        pieces.append(text)
+        position = max(position, line_no + removed)
+    if position < len(lines):
+        pieces.append("\n".join(lines[position:]) + "\n")
+    return "".join(pieces)[:-1] #the last line of the layer has no line end of its own
+
+## Writes the layers with a patch applied (see applyPatch) to a G-code file, layer by layer
+def writePatched(layers, patch, output_path):
+    with openGCode(output_path, "wb") as gcode_out:
+        for active_layer in applyPatch(layers, patch):
+            gcode_out.write(active_layer.encode(_ENCODING, _ERRORS))
+
+## Processes one file for processBatch and reports on it: input, output, ok, time, lines_changed (inserted and
+#  rewritten lines; a move rewritten by two stacked tweaks counts twice), lines_inserted (the lines the output has more
+#  than the input) and layers_rebuilt, or the error; an error is reported, not raised
+def processJob(input_path, output_path, entries, use_index = False):
+    start = time.perf_counter()
+    job = {"input": input_path, "output": output_path}
+    try:
+        report = processFile(input_path, output_path, entries, use_index, True)
+    except Exception as e:
+        job.update(ok = False, error = "%s: %s" % (type(e).__name__, e))
+    else:
+        job.update(ok = True, lines_changed = report["lines_inserted"] + report["moves_rewritten"],
+                   lines_inserted = report["lines_inserted"], layers_rebuilt = report["layers_rebuilt"])
+    job["time"] = time.perf_counter() - start
+    return job
+
+## Applies the same entries (see TweakAtZ.createProcessors) to many G-code files in a pool of worker processes and
+#  yields the report of each job as it is done (see processJob), a failed job doesn't stop the others.
+#  jobs: iterable of (input path, output path); only a few jobs per worker are queued at a time, so any no. of jobs
+#  can be given (e.g. as a generator), and each worker holds a single file, memory-mapped (see processFile).
+#  workers: no. of processes (None: all cores); with 1, or without processes, the jobs are done here one by one
+def processBatch(jobs, entries, workers = None, use_index = False):
+    import concurrent.futures
+    TweakAtZ().createProcessors(entries) #checks the settings once for all jobs
+    jobs = iter(jobs)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    executor = None
+    if workers > 1:
+        try:
+            executor = concurrent.futures.ProcessPoolExecutor(workers)
+        except Exception: #no processes available
+            executor = None
+    if executor is None:
+        for input_path, output_path in jobs:
+            yield processJob(input_path, output_path, entries, use_index)
+        return
+    pending = {}
+    try:
+        for job in jobs:
+            try:
+                future = executor.submit(processJob, job[0], job[1], entries, use_index)
+            except concurrent.futures.process.BrokenProcessPool: #a worker process died: the jobs go on in a new pool
+                executor.shutdown(wait = False)
+                executor = concurrent.futures.ProcessPoolExecutor(workers)
+                future = executor.submit(processJob, job[0], job[1], entries, use_index)
+            pending[future] = job
+            while len(pending) >= workers * 2:
+                for report in waitJobs(pending):
+                    yield report
+        while pending:
+            for report in waitJobs(pending):
+                yield report
+    finally:
+        for future in pending: #the jobs not started yet (when the generator is closed early)
+            future.cancel()
+        executor.shutdown(wait = not pending)
+
+## Takes the done jobs out of pending (futures of processBatch) as soon as there are any, and returns their reports
+def waitJobs(pending):
+    import concurrent.futures
+    done = concurrent.futures.wait(pending, return_when = concurrent.futures.FIRST_COMPLETED)[0]
+    reports = []
+    for future in done:
+        input_path, output_path = pending.pop(future)
+        try:
+            reports.append(future.result())
+        except Exception as e: #the job didn't even run, e.g. its worker process died
+            reports.append({"input": input_path, "output": output_path, "ok": False,
+                            "error": "%s: %s" % (type(e).__name__, e), "time": None})
+    return reports
+
+## Command line entry point, e.g. "python TweakAtZ.py in.gcode out.gcode --targetZ 5 --Tweak_bedTemp --bedTemp 50".
+#  The options are the settings of getSettingData, named without their ordering prefix ("b_targetZ" -> "--targetZ").
+#  With a folder as input, all G-code files in it are processed into the output folder (see processBatch), and the
+#  report of each job is printed as a line of JSON.
+def main(argv = None):
+    import argparse
+    tweak = TweakAtZ()
+    parser = argparse.ArgumentParser(prog = "TweakAtZ", description = "TweakAtZ %s - Change printing parameters at a "
+                                     "given height (standalone G-code post-processing)" % tweak.version)
+    parser.add_argument("input", help = "G-code file to read, or folder of G-code files (.gcode, .gcode.gz or .gcode.zst)")
+    parser.add_argument("output", help = "G-code file to write (compressed if it ends with .gz or .zst), or folder to "
+                        "write them to")
+    parser.add_argument("--workers", type = int, default = None, help = "no. of processes for a folder of G-code "
+                        "files (default: all cores)")
+    parser.add_argument("--index", action = "store_true", help = "use a layer index file next to the input (%s) to "
+                        "skip straight to the tweak; it is created on the first run" % LayerIndex.extension)
+    parser.add_argument("--report", action = "store_true", help = "print counters and timings of the run (JSON) to stderr")
+    parser.add_argument("--schedule", metavar = "FILE", help = "JSON file with a list of breakpoints [position, parameter, "
+                        "value, interpolation] to apply instead of the tweaks (see Schedule); the trigger tells whether "
+                        "the positions are heights or layer nos.")
+    for key, setting in sorted(tweak.getSettingData()["settings"].items()):
+        option = "--" + key.split("_", 1)[1]
+        description = "%s (%s, default: %s)" % (setting["description"], key, setting["default"])
+        if setting["type"] == "boolean":
+            parser.add_argument(option, dest = key, action = "store_true", help = description)
+        elif setting["type"] == "enum":
+            parser.add_argument(option, dest = key, choices = sorted(setting["options"]), default = setting["default"],
+                                help = description)
+        else:
+            parser.add_argument(option, dest = key, type = int if setting["type"] == "int" else float,
+                                default = setting["default"], metavar = "VALUE", help = description)
+    args = parser.parse_args(argv)
+    if args.input == args.output:
+        parser.error("input and output have to be different files")
+    if zstandard is None and any(path.lower().endswith(".zst") for path in (args.input, args.output)):
+        parser.error("zstd compressed G-code needs the zstandard module (pip install zstandard)")
+    settings = tweak.getDefaultSettings()
+    for key in settings:
+        settings[key] = getattr(args, key)
+    entries = [settings]
+    if args.schedule:
+        try:
+            with open(args.schedule, "r") as schedule_file:
+                entries = [Schedule(json.load(schedule_file), settings["a_trigger"])]
+        except OSError as e:
+            parser.error("can't read schedule: %s" % e)
+        except (ValueError, TypeError) as e: #also JSON which isn't a list of breakpoints
+            parser.error("invalid schedule: %s" % e)
+    if os.path.isdir(args.input):
+        os.makedirs(args.output, exist_ok = True)
+        names = sorted(name for name in os.listdir(args.input)
+                       if name.lower().endswith((".gcode",) + tuple(".gcode" + extension for extension in _COMPRESSED)))
+        jobs = ((os.path.join(args.input, name), os.path.join(args.output, name)) for name in names)
+        failed = 0
+        for job in processBatch(jobs, entries, args.workers, args.index):
+            failed += not job["ok"]
+            print(json.dumps(job))
+            sys.stdout.flush()
+        return 1 if failed else 0
+    report = processFile(args.input, args.output, entries, args.index, args.report)
+    if report is not None:
+        json.dump(report, sys.stderr, indent = 1)
+        sys.stderr.write("\n")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,314 @@
+# Benchmark for the TweakAtZ script - throughput (lines/s) and peak memory of TweakAtZ.execute
+# Runs offline: the Script base class of the PostProcessingPlugin is replaced by a stub, and the G-code is generated
+# synthetically in the style of Cura (layer markers, cool head lift, retraction hops, extruder switches, end code).
+#
+# Usage: python benchmarks/benchmark_TweakAtZ.py [--layers 200] [--moves 1000] [--flavor both] [--repeat 3]
+#        [--script path/to/TweakAtZ.py ...] [--write file.gcode] [--verify]
+# Several --script options compare different versions (engines) of the script on the same G-code.
+# With --verify, the other code paths of the script (parallel, incremental, cached, patch, generator, files) are
+# checked against the sequential TweakAtZ.execute instead, and the report of processJob against the lines inserted and
+# changed in its output (exit code 1 on any mismatch).
+
+import argparse
+import collections
+import gzip
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+DEFAULT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "TweakAtZ.py")
+
+## Stand-in for the Script class of the PostProcessingPlugin: settings are given as a dictionary,
+#  missing ones take the default value of getSettingData
+class StubScript(object):
+    def __init__(self):
+        self.settings = {}
+
+    def getSettingValueByKey(self, key):
+        if key in self.settings:
+            return self.settings[key]
+        return self.getSettingData()["settings"][key]["default"]
+
+## Loads a TweakAtZ.py as "PostProcessingPlugin.scripts.<name>", below a stub plugin package, as Cura would
+def loadScript(path, name):
+    if "PostProcessingPlugin" not in sys.modules:
+        for package in ("PostProcessingPlugin", "PostProcessingPlugin.scripts"):
+            module = types.ModuleType(package)
+            module.__path__ = []
+            sys.modules[package] = module
+        script_module = types.ModuleType("PostProcessingPlugin.Script")
+        script_module.Script = StubScript
+        sys.modules["PostProcessingPlugin.Script"] = script_module
+    spec = importlib.util.spec_from_file_location("PostProcessingPlugin.scripts." + name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    if getattr(module.TweakAtZ, "cache", None) is not None:
+        module.TweakAtZ.cache = None #the repeated runs would only measure the result cache
+    return module.TweakAtZ
+
+## Generates sliced G-code as Cura hands it to the PostProcessingPlugin: a list of strings with the header first,
+#  one string per layer and the end code last. flavor: "RepRap" (Marlin) or "UltiGCode".
+def generateGCode(layers = 200, moves = 1000, flavor = "RepRap", extruders = 2, seed = 0):
+    rand = random.Random(seed)
+    if flavor == "UltiGCode":
+        header = [";FLAVOR:UltiGCode", ";TIME:%d" % (layers * moves // 10), ";MATERIAL:%d" % (layers * moves),
+                  ";MATERIAL2:0", ";NOZZLE_DIAMETER:0.400000", ";Generated with Cura_SteamEngine 15.06.03",
+                  "G28", "M107", "G92 E0"]
+    else:
+        header = [";FLAVOR:RepRap", ";Generated with Cura_SteamEngine 15.06.03", "M140 S60", "M104 S205 T0",
+                  "M109 S205", "M190 S60", "M221 S100", "G21 ;metric values", "G90 ;absolute positioning",
+                  "M82 ;set extruder to absolute mode", "M107 ;start with the fan off", "G28 X0 Y0 ;move X/Y to min endstops",
+                  "G28 Z0 ;move Z to min endstops", "G1 Z15.0 F9000 ;move the platform down 15mm", "G92 E0",
+                  "G1 F200 E3", "G92 E0", "G1 F9000", "M117 Printing..."]
+    data = ["\n".join(header) + "\n"]
+    e = 0.0
+    extruder = 0
+    for layer in range(layers):
+        z = 0.3 + 0.1 * layer
+        lines = [";LAYER:%d" % layer]
+        if layer % 9 == 4: #cool head lift on small layers
+            lines += [";Small layer, adding delay", "G0 F9000 X%.3f Y%.3f Z%.3f" % (rand.uniform(0, 200), rand.uniform(0, 200), z + 3),
+                      "G4 P2000"]
+        if layer == 1:
+            lines.append("M106 S255")
+        if extruders > 1 and layer % 20 == 10:
+            extruder = (extruder + 1) % extruders
+            lines += ["G1 F2400 E%.5f" % (e - 16.5), "T%d" % extruder, "M104 S205 T%d" % extruder,
+                      "G92 E%.5f" % (e - 16.5), "G1 F2400 E%.5f" % e]
+        lines.append("G0 F9000 X%.3f Y%.3f Z%.3f" % (rand.uniform(0, 200), rand.uniform(0, 200), z))
+        for move in range(moves):
+            if move % 250 == 0:
+                lines.append(";TYPE:%s" % rand.choice(("WALL-OUTER", "WALL-INNER", "SKIN", "FILL")))
+            if move % 40 == 39: #retraction with hop
+                lines += ["G1 F2400 E%.5f" % (e - 4.5), "G1 Z%.3f" % (z + 0.5),
+                          "G0 F9000 X%.3f Y%.3f" % (rand.uniform(0, 200), rand.uniform(0, 200)),
+                          "G1 Z%.3f" % z, "G1 F2400 E%.5f" % e]
+            e += rand.uniform(0.01, 0.2)
+            if move % 50 == 0:
+                lines.append("G1 F1200 X%.3f Y%.3f E%.5f" % (rand.uniform(0, 200), rand.uniform(0, 200), e))
+            else:
+                lines.append("G1 X%.3f Y%.3f E%.5f" % (rand.uniform(0, 200), rand.uniform(0, 200), e))
+        data.append("\n".join(lines) + "\n")
+    if flavor == "UltiGCode":
+        end = ["M107", "M25 ;stop reading from SD card", "G28 ;home all axes", "M84 ;disable motors"]
+    else:
+        end = [";End GCode", "M104 S0", "M140 S0", "G91", "G1 E-1 F300", "G1 Z+0.5 E-5 X-20 Y-20 F9000",
+               "G28 X0 Y0", "M84 ;steppers off", "G90"]
+    data.append("\n".join(end) + "\n")
+    return data
+
+## The tweak combinations to time: name and settings (keys as in getSettingData)
+def getCases(layers):
+    height = round(0.3 + 0.1 * layers / 3, 2) #a third of the print
+    temps = {"h1_Tweak_bedTemp": True, "h2_bedTemp": 50, "i1_Tweak_extruderOne": True, "i2_extruderOne": 215}
+    return [
+        ("temperatures keep_value", dict(temps, b_targetZ = height)),
+        ("temperatures single_layer", dict(temps, b_targetZ = height, c_behavior = "single_layer")),
+        ("fan ramp over 10 layers", {"b_targetZ": height, "d_twLayers": 10, "j1_Tweak_fanSpeed": True, "j2_fanSpeed": 120}),
+        ("flow per extruder at layer", {"a_trigger": "layer_no", "b_targetL": layers // 3, "g3_Tweak_flowrateOne": True,
+                                        "g4_flowrateOne": 95, "g5_Tweak_flowrateTwo": True, "g6_flowrateTwo": 105}),
+        ("speed keep_value", {"b_targetZ": height, "e1_Tweak_speed": True, "e2_speed": 80}),
+        ("print speed keep_value", {"b_targetZ": height, "f1_Tweak_printspeed": True, "f2_printspeed": 80}),
+        ("print speed single_layer", {"b_targetZ": height, "f1_Tweak_printspeed": True, "f2_printspeed": 80,
+                                      "c_behavior": "single_layer"}),
+    ]
+
+## Runs one case; returns (best time in s, peak memory in bytes) or the error
+def runCase(script_class, data, settings, repeat):
+    best = None
+    try:
+        for run in range(repeat):
+            script = script_class()
+            script.settings = dict(settings)
+            layers = list(data)
+            start = time.perf_counter()
+            script.execute(layers)
+            duration = time.perf_counter() - start
+            best = duration if best is None else min(best, duration)
+        script = script_class() #the peak memory is measured in an extra run, as tracemalloc slows down
+        script.settings = dict(settings)
+        layers = list(data)
+        tracemalloc.start()
+        script.execute(layers)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    except Exception as e:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        return "%s: %s" % (type(e).__name__, e)
+    return best, peak
+
+## A script instance which neither uses the result cache nor the incremental state, i.e. the plain sequential execute
+def createScript(script_class):
+    script = script_class()
+    script.cache = None
+    script.incremental = False
+    return script
+
+## The entries to verify: each case alone, all of them stacked and, if the script has schedules, a schedule
+def getVerifyEntries(module, layers):
+    cases = getCases(layers)
+    entries = [(name, [settings]) for name, settings in cases]
+    entries.append(("all stacked", [settings for name, settings in cases]))
+    if hasattr(module, "Schedule"):
+        entries.append(("schedule", [module.Schedule([(0.5, "fanSpeed", 0), (2.0, "fanSpeed", 255, "linear"),
+                                                      (1.0, "extruderOne", 200), (3.0, "extruderOne", 220)])]))
+    return entries
+
+## Yields (path, result) of each code path of the script for the entries; the layers of the file paths are the chunks
+#  of the file as readLayers cuts them. Paths which the script doesn't have are left out.
+def runPaths(script_class, module, data, entries, other_entries, path):
+    script = createScript(script_class)
+    script.parallel_min_size = 0
+    yield "parallel", script.execute(list(data), entries, workers = 2)
+    if hasattr(script, "incremental"): #after a run with other settings on the same data
+        script = createScript(script_class)
+        script.incremental = True
+        script.execute(list(data), other_entries)
+        yield "incremental", script.execute(list(data), entries)
+    if hasattr(module, "ResultCache"): #the second run is served by the cache
+        script = createScript(script_class)
+        script.cache = module.ResultCache()
+        script.execute(list(data), entries)
+        yield "cached", script.execute(list(data), entries)
+    if hasattr(script, "executePatch"):
+        yield "patch", list(module.applyPatch(list(data), createScript(script_class).executePatch(list(data), entries)))
+    if hasattr(script, "executeIter"):
+        yield "generator", list(createScript(script_class).executeIter(iter(data), entries))
+    if hasattr(module, "processFile"):
+        output_path = path + ".out"
+        module.processFile(path, output_path, entries)
+        yield "file", readFile(output_path)
+        module.processFile(path + ".gz", output_path + ".gz", entries)
+        yield "file gzip", readFile(output_path + ".gz")
+        if hasattr(module, "LayerIndex"):
+            if os.path.exists(path + module.LayerIndex.extension):
+                os.remove(path + module.LayerIndex.extension)
+            module.processFile(path, output_path, entries, True)
+            yield "file index (new)", readFile(output_path)
+            module.processFile(path, output_path, entries, True)
+            yield "file index (used)", readFile(output_path)
+    if hasattr(module, "iterFile"):
+        yield "file generator", b"".join(module.iterFile(path, entries)).decode("utf-8", "surrogateescape")
+
+## Checks the report of processJob against its output: lines_inserted has to be the no. of lines the output has more
+#  than the input and, for a single tweak, lines_changed the no. of output lines which are new or changed, i.e. not in
+#  the input (as often); stacked tweaks may change the same line. Returns the outcome as verify prints it.
+def checkJob(module, path, entries):
+    output_path = path + ".out"
+    job = module.processJob(path, output_path, entries)
+    if not job["ok"]:
+        return job["error"]
+    input_lines = readFile(path).split("\n")
+    output_lines = readFile(output_path).split("\n")
+    if job["lines_inserted"] != len(output_lines) - len(input_lines):
+        return "MISMATCH lines_inserted %d, %d in the output" % (job["lines_inserted"],
+                                                                len(output_lines) - len(input_lines))
+    changed = sum((collections.Counter(output_lines) - collections.Counter(input_lines)).values())
+    if len(entries) == 1 and job["lines_changed"] != changed:
+        return "MISMATCH lines_changed %d, %d in the output" % (job["lines_changed"], changed)
+    return "ok"
+
+## Position of the first difference of two lists of layers or two strings
+def findMismatch(result, expected):
+    return next((index for index, (a, b) in enumerate(zip(result, expected)) if a != b),
+                min(len(result), len(expected)))
+
+def readFile(path):
+    with (gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")) as gcode_file:
+        return gcode_file.read().decode("utf-8", "surrogateescape")
+
+## Checks every code path of a script against its sequential execute on the same G-code and prints the result of each;
+#  returns the no. of mismatches
+def verify(script_class, data, flavor, label, directory):
+    module = sys.modules[script_class.__module__]
+    path = os.path.join(directory, "verify.gcode")
+    raw = "".join(data).encode("utf-8")
+    with open(path, "wb") as gcode_file:
+        gcode_file.write(raw)
+    with gzip.open(path + ".gz", "wb") as gcode_file:
+        gcode_file.write(raw)
+    chunks = None
+    if hasattr(module, "readLayers"):
+        with open(path, "rb") as gcode_file:
+            chunks = [chunk.decode("utf-8", "surrogateescape")
+                      for chunk in module.readLayers(gcode_file, marker = b";LAYER:")]
+    entries = getVerifyEntries(module, len(data) - 2)
+    failures = 0
+    for number, (name, entry) in enumerate(entries):
+        reference = createScript(script_class).execute(list(data), entry)
+        file_reference = None
+        if chunks is not None:
+            file_reference = "".join(createScript(script_class).execute(list(chunks), entry))
+        other_entry = entries[number - 1][1]
+        for path_name, result in runPaths(script_class, module, data, entry, other_entry, path):
+            expected = file_reference if path_name.startswith("file") else reference
+            if result == expected:
+                outcome = "ok"
+            else:
+                failures += 1
+                outcome = "MISMATCH at %s %d" % ("layer" if isinstance(result, list) else "character",
+                                                 findMismatch(result, expected))
+            print("%-28s %-10s %-24s %-18s %s" % (name, flavor, label[-24:], path_name, outcome))
+        if hasattr(module, "processJob"):
+            outcome = checkJob(module, path, entry)
+            if outcome != "ok":
+                failures += 1
+            print("%-28s %-10s %-24s %-18s %s" % (name, flavor, label[-24:], "job report", outcome))
+    return failures
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark of TweakAtZ.execute on synthetic Cura G-code")
+    parser.add_argument("--layers", type = int, default = 200, help = "no. of layers (default: 200)")
+    parser.add_argument("--moves", type = int, default = 1000, help = "extrusion moves per layer (default: 1000)")
+    parser.add_argument("--flavor", choices = ("RepRap", "UltiGCode", "both"), default = "both")
+    parser.add_argument("--extruders", type = int, default = 2)
+    parser.add_argument("--repeat", type = int, default = 3, help = "runs per case, the best one counts (default: 3)")
+    parser.add_argument("--script", action = "append", help = "TweakAtZ.py to benchmark, may be repeated to compare "
+                        "versions (default: the one of this repository)")
+    parser.add_argument("--write", metavar = "FILE", help = "only write the generated G-code (first flavor) to FILE")
+    parser.add_argument("--verify", action = "store_true", help = "check the other code paths against the sequential "
+                        "execute instead of timing it")
+    args = parser.parse_args(argv)
+
+    flavors = ("RepRap", "UltiGCode") if args.flavor == "both" else (args.flavor,)
+    if args.write:
+        with open(args.write, "w") as gcode_file:
+            gcode_file.write("".join(generateGCode(args.layers, args.moves, flavors[0], args.extruders)))
+        return 0
+    scripts = [(path, loadScript(path, "TweakAtZ_%d" % number)) for number, path in enumerate(args.script or [DEFAULT_SCRIPT])]
+    if args.verify:
+        failures = 0
+        print("%-28s %-10s %-24s %-18s %s" % ("case", "flavor", "script", "path", "result"))
+        with tempfile.TemporaryDirectory() as directory:
+            for flavor in flavors:
+                data = generateGCode(args.layers, args.moves, flavor, args.extruders)
+                for path, script_class in scripts:
+                    label = os.path.basename(os.path.dirname(os.path.abspath(path))) + "/" + os.path.basename(path)
+                    failures += verify(script_class, data, flavor, label, directory)
+        print("%d mismatch(es)" % failures)
+        return 1 if failures else 0
+    print("%-28s %-10s %-24s %9s %12s %10s" % ("case", "flavor", "script", "time [s]", "lines/s", "peak [MB]"))
+    for flavor in flavors:
+        data = generateGCode(args.layers, args.moves, flavor, args.extruders)
+        lines = sum(layer.count("\n") for layer in data)
+        for name, settings in getCases(args.layers):
+            for path, script_class in scripts:
+                result = runCase(script_class, data, settings, args.repeat)
+                label = os.path.basename(os.path.dirname(os.path.abspath(path))) + "/" + os.path.basename(path)
+                if isinstance(result, str):
+                    print("%-28s %-10s %-24s %s" % (name, flavor, label[-24:], result))
+                else:
+                    duration, peak = result
+                    print("%-28s %-10s %-24s %9.3f %12.0f %10.1f" % (name, flavor, label[-24:], duration,
+                                                                      lines / duration, peak / 1e6))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+# Stand-in printer for TweakAtZ - a local TCP socket which takes G-code as a print host would send it to a printer
+# It counts the bytes and commands it gets and the time of the first ones, so the time to the first byte of a host which
+# sends the result of TweakAtZ.execute (all layers at once) can be compared to one which streams TweakAtZ.executeIter.
+#
+# Usage: python benchmarks/standin_printer.py [--layers 500] [--moves 1000] [--settings '{"b_targetZ": 5}']
+#        [--file in.gcode] [--script path/to/TweakAtZ.py]
+#        python benchmarks/standin_printer.py --serve 2560 (only the printer, for a host of your own; one job per connection)
+
+import argparse
+import json
+import socket
+import sys
+import threading
+import time
+
+from benchmark_TweakAtZ import DEFAULT_SCRIPT, generateGCode, loadScript
+
+## The printer: accepts one connection after the other and reads G-code from each until the host closes its side.
+#  Then it answers with a summary line (JSON): bytes, commands (lines which aren't empty or comments only) and the
+#  time (time.perf_counter) of the connection, the first byte, the first command and the end.
+#  line_time: time to take for each command, like a printer which executes them (default: none)
+class StandinPrinter(object):
+    def __init__(self, host = "127.0.0.1", port = 0, line_time = 0.0):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(1)
+        self.address = self.server.getsockname()
+        self.line_time = line_time
+        self.jobs = [] #the summaries of the jobs done
+
+    def start(self):
+        thread = threading.Thread(target = self.serve, daemon = True)
+        thread.start()
+        return thread
+
+    def serve(self):
+        while True:
+            try:
+                connection = self.server.accept()[0]
+            except OSError: #closed
+                return
+            with connection:
+                job = self.receive(connection)
+                self.jobs.append(job)
+                connection.sendall((json.dumps(job) + "\n").encode("ascii"))
+
+    def receive(self, connection):
+        job = {"connected": time.perf_counter(), "first_byte": None, "first_command": None, "bytes": 0, "commands": 0}
+        pending = b""
+        while True:
+            block = connection.recv(1 << 16)
+            if not block:
+                break
+            if job["first_byte"] is None:
+                job["first_byte"] = time.perf_counter()
+            job["bytes"] += len(block)
+            lines = (pending + block).split(b"\n")
+            pending = lines.pop()
+            commands = sum(1 for line in lines if line.split(b";", 1)[0].strip())
+            if commands and job["first_command"] is None:
+                job["first_command"] = time.perf_counter()
+            job["commands"] += commands
+            if self.line_time:
+                time.sleep(commands * self.line_time)
+        if pending.split(b";", 1)[0].strip():
+            job["commands"] += 1
+        job["end"] = time.perf_counter()
+        return job
+
+    def close(self):
+        self.server.close()
+
+## Sends G-code in chunks (bytes) to a printer and returns its summary of the job
+def sendGCode(chunks, address):
+    with socket.create_connection(address) as connection:
+        for chunk in chunks:
+            connection.sendall(chunk)
+        connection.shutdown(socket.SHUT_WR)
+        reply = b""
+        while not reply.endswith(b"\n"):
+            block = connection.recv(4096)
+            if not block:
+                break
+            reply += block
+    return json.loads(reply.decode("ascii"))
+
+## The two ways of a host to send processed G-code: all layers after execute is done, or each layer as soon as
+#  executeIter yields it
+def sendExecuted(script_class, data, settings, address):
+    script = script_class()
+    return sendGCode((layer.encode("utf-8") for layer in script.execute(list(data), [settings])), address)
+
+def sendStreamed(script_class, data, settings, address):
+    script = script_class()
+    return sendGCode((layer.encode("utf-8") for layer in script.executeIter(iter(data), [settings])), address)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Stand-in printer on a local socket: time to the first byte of "
+                                     "TweakAtZ.execute vs. TweakAtZ.executeIter")
+    parser.add_argument("--serve", type = int, metavar = "PORT", help = "only run the printer on this port")
+    parser.add_argument("--line-time", type = float, default = 0.0, help = "time per command of the printer in s "
+                        "(default: 0)")
+    parser.add_argument("--layers", type = int, default = 500, help = "no. of layers of the synthetic G-code (default: 500)")
+    parser.add_argument("--moves", type = int, default = 1000, help = "extrusion moves per layer (default: 1000)")
+    parser.add_argument("--file", help = "G-code file to send instead of the synthetic G-code")
+    parser.add_argument("--settings", default = '{"b_targetZ": 5.0, "h1_Tweak_bedTemp": true, "h2_bedTemp": 50}',
+                        help = "TweakAtZ settings as JSON (keys as in getSettingData)")
+    parser.add_argument("--script", default = DEFAULT_SCRIPT, help = "TweakAtZ.py to use (default: the one of this "
+                        "repository)")
+    args = parser.parse_args(argv)
+
+    if args.serve is not None:
+        printer = StandinPrinter(port = args.serve, line_time = args.line_time)
+        print("stand-in printer on %s:%d" % printer.address)
+        sys.stdout.flush()
+        try:
+            printer.serve()
+        except KeyboardInterrupt:
+            pass
+        return 0
+    script_class = loadScript(args.script, "TweakAtZ_host")
+    settings = json.loads(args.settings)
+    if args.file:
+        module = sys.modules[script_class.__module__]
+        with open(args.file, "rb") as gcode_file:
+            data = [chunk.decode("utf-8", "surrogateescape") for chunk in module.readLayers(gcode_file, marker = b";LAYER:")]
+    else:
+        data = generateGCode(args.layers, args.moves)
+    printer = StandinPrinter(line_time = args.line_time)
+    printer.start()
+    print("%-10s %16s %16s %10s %12s" % ("host", "first byte [s]", "first cmd [s]", "total [s]", "commands"))
+    try:
+        for name, send in (("execute", sendExecuted), ("streamed", sendStreamed)):
+            start = time.perf_counter()
+            job = send(script_class, data, settings, printer.address)
+            print("%-10s %16.3f %16.3f %10.3f %12d" % (name, job["first_byte"] - start, job["first_command"] - start,
+                                                      job["end"] - start, job["commands"]))
+    finally:
+        printer.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())